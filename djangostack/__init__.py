@@ -1,13 +1,167 @@
 import time
 import datetime
+import fnmatch
+import functools
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
+try:
+    from urllib.parse import quote as url_quote
+except ImportError:
+    from urllib import quote as url_quote
 
 from taskset import TaskSet, task_method
 from fabric.api import *
-from fabric.contrib.files import exists, append, contains
 from cuisine import *
+from fabric.state import connections
 from cuisine_postgresql import postgresql_role_ensure, \
     postgresql_database_ensure
 
+from djangostack.telemetry import describe, summarise
+
+
+# Generated nginx site configuration, used when web_server is nginx and no
+# web_server_config_name is given. Sections in NGINX_STATIC_TEMPLATE and
+# NGINX_MICRO_CACHE_TEMPLATE are only included when the matching attribute is set.
+NGINX_SITE_TEMPLATE = """\
+upstream %(name)s_uwsgi {
+    server %(uwsgi_socket)s;
+}
+%(http_extra)s
+server {
+    listen 80;
+    server_name %(server_name)s;
+    client_max_body_size %(client_max_body_size)s;
+
+    sendfile on;
+    tcp_nopush on;
+    tcp_nodelay on;
+    keepalive_timeout 65;
+
+    gzip on;
+    gzip_vary on;
+    gzip_proxied any;
+    gzip_comp_level 5;
+    gzip_min_length 256;
+    gzip_types text/plain text/css text/xml application/json application/javascript
+               application/xml application/rss+xml image/svg+xml;
+%(static)s
+    location / {
+        uwsgi_pass %(name)s_uwsgi;
+        include %(uwsgi_params_path)s;%(micro_cache)s
+    }
+}
+"""
+
+NGINX_STATIC_HTTP_TEMPLATE = """
+# Files carrying a content hash (ManifestStaticFilesStorage) never change.
+map $uri $%(name)s_static_expires {
+    default 1h;
+    "~\\.[0-9a-f]{12}\\.\\w+$" max;
+}
+"""
+
+NGINX_STATIC_TEMPLATE = """
+    location %(static_url)s {
+        alias %(static_path)s;
+        gzip_static on;
+        expires $%(name)s_static_expires;
+        access_log off;
+    }
+"""
+
+NGINX_MICRO_CACHE_HTTP_TEMPLATE = """
+uwsgi_cache_path /var/cache/nginx/%(name)s levels=1:2 keys_zone=%(name)s:10m
+                 max_size=256m inactive=10m;
+"""
+
+NGINX_MICRO_CACHE_TEMPLATE = """
+        # Micro-cache anonymous GET/HEAD traffic.
+        uwsgi_cache %(name)s;
+        uwsgi_cache_key $scheme$host$request_uri;
+        uwsgi_cache_valid 200 301 302 %(micro_cache_seconds)ss;
+        uwsgi_cache_lock on;
+        uwsgi_cache_use_stale updating error timeout;
+        uwsgi_cache_bypass $cookie_sessionid $http_authorization;
+        uwsgi_no_cache $cookie_sessionid $http_authorization;"""
+
+
+def stage(func):
+    # Mark a DjangoStack method as a deployment stage. Stages are timed, and every
+    # remote operation issued while one is running is attributed to it. Stages
+    # called from within another stage are folded into the outer one.
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self._current_stage is not None:
+            return func(self, *args, **kwargs)
+        self._current_stage = func.__name__
+        start = time.time()
+        if self._telemetry_monitor:
+            self._telemetry_monitor.stage_started(func.__name__, start)
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            if self.plan is None:
+                self.stage_timings[func.__name__] = round(time.time() - start, 2)
+            if self._telemetry_monitor:
+                self._telemetry_monitor.stage_started(None, None)
+                # Telemetry must not replace the exception a failed stage raised.
+                try:
+                    self._stage_telemetry(func.__name__, start, time.time())
+                except (Exception, SystemExit) as e:
+                    warn('Could not collect telemetry for %s: %s' % (func.__name__, e))
+            self._current_stage = None
+    return wrapper
+
+
+TELEMETRY_SAMPLES_PATH = '/tmp/djangostack_telemetry.jsonl'  # Written by telemetry.py on the host
+TELEMETRY_PID_PATH = '/tmp/djangostack_telemetry.pid'  # Process id of telemetry.py on the host
+
+
+def host_name(host_string):
+    # The host name part of a fabric host string (user@host:port).
+    return host_string.split('@')[-1].split(':')[0]
+
+
+def sql_literal(value):
+    # Quote value as an SQL string literal.
+    return "'%s'" % value.replace("'", "''")
+
+
+def sql_identifier(value):
+    # Quote value as an SQL identifier.
+    return '"%s"' % value.replace('"', '""')
+
+
+def nginx_worker_connections(memory_mb, cpu_count, open_files=None):
+    # worker_connections for a host: 8 connections per MB of memory (about 128KB
+    # of buffers per active proxied connection) shared between the workers, at
+    # most half of a worker's open_files (a proxied request holds two
+    # descriptors), and between 1024 and 65535.
+    connections = memory_mb * 8 // max(cpu_count, 1)
+    if open_files:
+        connections = min(connections, open_files // 2)
+    return min(max(connections, 1024), 65535)
+
+
+def operation_key(kind, description):
+    # Key under which an operation's timing is stored in the deploy state.
+    return '%s:%s' % (kind, description)
+
 
 class DjangoStack(TaskSet):
     """
@@ -20,9 +174,14 @@ class DjangoStack(TaskSet):
     deploy_django = True  # Deploy Django
     deploy_web_server = True  # Deploy Web Server
     deploy_postgis = True # Deploy a Postigs installation for postgres
+    deploy_cache = False  # Deploy a Redis/Memcached cache tier
     restore_database = False  # Restore Database
     WEB_SERVERS = ['apache', 'nginx']
     SCM_TYPES = ['mercurial', 'git']
+    CACHE_TYPES = ['redis', 'memcached']
+    LOAD_TEST_FAILURE_ACTIONS = ['abort', 'rollback', 'warn']
+    LOAD_BALANCER_TYPES = ['haproxy', 'nginx']
+    EXECUTION_BACKENDS = ['fabric', 'asyncssh']
     default_additional_packages = ['vim', 'gettext']  # System packages to install
     # Python packages to install
     default_python_dependencies = ['psycopg2']
@@ -32,7 +191,24 @@ class DjangoStack(TaskSet):
     uwsgi_ini_path = None  # Path to copy uwsgi.ini file to (nginx only)
     uwsgi_params_name = None  # Local uwsgi_params file name (nginx only)
     uwsgi_params_path = None  # Path to copy uwsgi_params file to (nginx only)
+    uwsgi_socket = None  # Socket uwsgi.ini binds to, defaults to unix:/tmp/<project_name>.sock (nginx only)
+    nginx_server_name = '_'  # server_name of the generated nginx site
+    nginx_static_url = '/static/'  # URL the generated nginx site serves django_static_path at
+    nginx_worker_connections = None  # If not specified, sized to the host's open file limit
+    nginx_client_max_body_size = '10m'  # client_max_body_size of the generated nginx site
+    nginx_micro_cache_seconds = 0  # Micro-cache anonymous GET responses for this long (0 disables)
+    use_virtualenv = False  # Install python dependencies into a virtualenv per set of requirements
+    virtualenv_root = None  # Where the virtualenvs are built, defaults to /var/virtualenvs/<project_name>/
+    prebuilt_virtualenv_name = None  # Local tar.gz of a virtualenv built at the same path to start from
+    virtualenv_keep = 3  # Number of virtualenvs kept, including the active one
     scm_type = 'mercurial'  # Version control to use
+    cache_type = 'redis'  # Cache server to install
+    cache_memory_mb = None  # Cache memory limit, if not specified a quarter of the host's memory
+    cache_eviction_policy = 'allkeys-lru'  # Redis maxmemory-policy (memcached always evicts LRU)
+    cache_host = None  # Host of a shared cache tier, if not specified the cache runs on the deployed server
+    cache_listen_address = None  # Private address a shared cache server listens on (setup_cache_host)
+    cache_password = None  # Redis requirepass, also given to Django in the cache LOCATION
+    session_engine = 'django.contrib.sessions.backends.cached_db'  # Django SESSION_ENGINE used with the cache
     database_name = None  # Database name to create
     database_user = None  # Database user to create
     database_password = None  # Database user password
@@ -53,7 +229,41 @@ class DjangoStack(TaskSet):
     # django_locale_path must contain a .tx directory which contains the transifex config file
     use_transifex = False
     transifexrc_name = None  # Local .transifexrc file name
+    warmup_urls = None  # URL paths requested after restart to warm up the workers (None skips)
+    warmup_base_url = 'http://127.0.0.1'  # Base URL the warmup and load test requests are made to
+    warmup_concurrency = None  # Concurrent requests, if not specified twice the host's CPU count
+    warmup_max_rounds = 10  # Give up waiting for the warmup latency to settle after this many rounds
+    load_test_seconds = 10  # Length of the load test run after warmup (0 disables)
+    load_test_max_regression = 0.25  # Allowed p99 latency increase over the previous release
+    load_test_failure_action = 'abort'  # What to do when the load test fails
+    package_proxy_host = None  # Host of the apt/PyPI caching proxy used during the run (None skips)
+    deploy_package_proxy = False  # Set up the caching proxy on package_proxy_host before a rolling deploy
+    apt_proxy_port = 3142  # apt-cacher-ng port on package_proxy_host
+    pip_proxy_port = 3141  # devpi-server port on package_proxy_host
+    package_lists_max_age = None  # Skip package_update if the apt lists are younger (seconds)
+    execution_backend = 'fabric'  # How remote commands are executed
+    max_concurrent_commands = 100  # Commands run_on_hosts runs at once (asyncssh only)
+    confirm_redeploy = True  # Prompt before deploying over a previous DjangoStack deployment
+    rolling_hosts = None  # Hosts of a rolling deployment, if not specified all hosts of the fab run
+    rolling_batch_size = 1  # Hosts deployed at once, a count or a percentage such as '25%'
+    load_balancer_host = None  # Host of the load balancer hosts are drained from (None skips draining)
+    load_balancer_type = 'haproxy'  # Type of load balancer
+    load_balancer_servers = None  # Maps a host to its load balancer server name (haproxy) or address (nginx)
+    haproxy_backend = None  # HAProxy backend the hosts belong to
+    haproxy_socket_path = '/var/run/haproxy/admin.sock'  # HAProxy admin socket
+    nginx_upstream_config_path = None  # nginx config file holding the upstream block
+    drain_seconds = 10  # Time allowed for in-flight requests after draining a host
+    health_check_url = '/'  # URL path that must respond once a host has been deployed
+    health_check_retries = 5  # Health check attempts, 3 seconds apart
+    site_host = None  # Host header of health checks and warmup, defaults to the first nginx_server_name
+    telemetry = False  # Sample the host's CPU, memory, disk and network during each stage
+    telemetry_interval = 1  # Seconds between telemetry samples
+    telemetry_progress_interval = 10  # Seconds between progress lines of a running stage
+    telemetry_export_dir = 'djangostack_telemetry'  # Local directory the telemetry is exported to
     verbosity = None   # Verbosity setting
+    deploy_state_path = '~/.djangostack.json'  # Remote deploy state (timings etc.)
+    host_facts_name = '.djangostack_facts.json'  # Local cache of gathered host facts
+    host_facts_max_age = 24 * 3600  # Seconds after which cached host facts are gathered again
 
     def __init__(self, project_name, **kwargs):
         # Initialize
@@ -64,6 +274,7 @@ class DjangoStack(TaskSet):
             self.default_python_dependencies.remove('psycopg2')
         self.deploy_django = kwargs.get('deploy_django', self.deploy_django)
         self.deploy_web_server = kwargs.get('deploy_web_server', self.deploy_web_server)
+        self.deploy_cache = kwargs.get('deploy_cache', self.deploy_cache)
         self.restore_database = kwargs.get('restore_database', self.restore_database)
         self.python_dependencies = self.default_python_dependencies
         self.web_server = kwargs.get('web_server', self.web_server)
@@ -78,6 +289,22 @@ class DjangoStack(TaskSet):
         self.uwsgi_ini_path = kwargs.get('uwsgi_ini_path', self.uwsgi_ini_path)
         self.uwsgi_params_name = kwargs.get('uwsgi_params_name', self.uwsgi_params_name)
         self.uwsgi_params_path = kwargs.get('uwsgi_params_path', self.uwsgi_params_path)
+        self.uwsgi_socket = kwargs.get('uwsgi_socket', self.uwsgi_socket) or \
+            'unix:/tmp/%s.sock' % self.project_name
+        self.nginx_server_name = kwargs.get('nginx_server_name', self.nginx_server_name)
+        self.nginx_static_url = kwargs.get('nginx_static_url', self.nginx_static_url)
+        self.nginx_worker_connections = \
+            kwargs.get('nginx_worker_connections', self.nginx_worker_connections)
+        self.nginx_client_max_body_size = \
+            kwargs.get('nginx_client_max_body_size', self.nginx_client_max_body_size)
+        self.nginx_micro_cache_seconds = \
+            kwargs.get('nginx_micro_cache_seconds', self.nginx_micro_cache_seconds)
+        if self.deploy_web_server and self.web_server == 'apache' and \
+                not self.web_server_config_name:
+            raise InvalidArgumentException(
+                'web_server_config_name must be specified if web_server is set to apache. '
+                'A configuration is only generated for nginx.'
+            )
         if self.deploy_web_server and self.web_server == 'nginx' and \
                 (not self.uwsgi_ini_path or not self.uwsgi_params_path):
             raise InvalidArgumentException(
@@ -86,12 +313,33 @@ class DjangoStack(TaskSet):
                 '(default) if you know these files will exist on the server or in a cloned '
                 'repository.'
             )
+        self.use_virtualenv = kwargs.get('use_virtualenv', self.use_virtualenv)
+        self.virtualenv_root = kwargs.get('virtualenv_root', self.virtualenv_root) or \
+            '/var/virtualenvs/%s/' % self.project_name
+        if not self.virtualenv_root.endswith('/'):
+            self.virtualenv_root += '/'
+        self.prebuilt_virtualenv_name = \
+            kwargs.get('prebuilt_virtualenv_name', self.prebuilt_virtualenv_name)
+        self.virtualenv_keep = kwargs.get('virtualenv_keep', self.virtualenv_keep)
         self.scm_type = kwargs.get('scm_type', self.scm_type)
         if self.scm_type not in self.SCM_TYPES:
             raise InvalidArgumentException(
                 '%s is not a valid scm_type. Options are: %s' %
                 (self.scm_type, self.SCM_TYPES)
             )
+        self.cache_type = kwargs.get('cache_type', self.cache_type)
+        if self.deploy_cache and self.cache_type not in self.CACHE_TYPES:
+            raise InvalidArgumentException(
+                '%s is not a valid cache_type. Options are: %s' %
+                (self.cache_type, self.CACHE_TYPES)
+            )
+        self.cache_memory_mb = kwargs.get('cache_memory_mb', self.cache_memory_mb)
+        self.cache_eviction_policy = \
+            kwargs.get('cache_eviction_policy', self.cache_eviction_policy)
+        self.cache_host = kwargs.get('cache_host', self.cache_host)
+        self.cache_listen_address = kwargs.get('cache_listen_address', self.cache_listen_address)
+        self.cache_password = kwargs.get('cache_password', self.cache_password)
+        self.session_engine = kwargs.get('session_engine', self.session_engine)
         self.database_name = kwargs.get('database_name', self.database_name)
         self.database_user = kwargs.get('database_user', self.database_user)
         self.database_password = kwargs.get('database_password', self.database_password)
@@ -120,7 +368,79 @@ class DjangoStack(TaskSet):
         self.django_locale_path = kwargs.get('django_locale_path', self.django_locale_path)
         self.use_transifex = kwargs.get('use_transifex', self.use_transifex)
         self.transifexrc_name = kwargs.get('transifexrc_name', self.transifexrc_name)
+        self.warmup_urls = kwargs.get('warmup_urls', self.warmup_urls)
+        self.warmup_base_url = kwargs.get('warmup_base_url', self.warmup_base_url)
+        self.warmup_concurrency = kwargs.get('warmup_concurrency', self.warmup_concurrency)
+        self.warmup_max_rounds = kwargs.get('warmup_max_rounds', self.warmup_max_rounds)
+        self.load_test_seconds = kwargs.get('load_test_seconds', self.load_test_seconds)
+        self.load_test_max_regression = \
+            kwargs.get('load_test_max_regression', self.load_test_max_regression)
+        self.load_test_failure_action = \
+            kwargs.get('load_test_failure_action', self.load_test_failure_action)
+        if self.load_test_failure_action not in self.LOAD_TEST_FAILURE_ACTIONS:
+            raise InvalidArgumentException(
+                '%s is not a valid load_test_failure_action. Options are: %s' %
+                (self.load_test_failure_action, self.LOAD_TEST_FAILURE_ACTIONS)
+            )
+        self.package_proxy_host = kwargs.get('package_proxy_host', self.package_proxy_host)
+        self.deploy_package_proxy = kwargs.get('deploy_package_proxy', self.deploy_package_proxy)
+        self.apt_proxy_port = kwargs.get('apt_proxy_port', self.apt_proxy_port)
+        self.pip_proxy_port = kwargs.get('pip_proxy_port', self.pip_proxy_port)
+        self.package_lists_max_age = \
+            kwargs.get('package_lists_max_age', self.package_lists_max_age)
+        self.execution_backend = kwargs.get('execution_backend', self.execution_backend)
+        self.max_concurrent_commands = \
+            kwargs.get('max_concurrent_commands', self.max_concurrent_commands)
+        self.backend = None  # Fabric is used directly
+        if self.execution_backend not in self.EXECUTION_BACKENDS:
+            raise InvalidArgumentException(
+                '%s is not a valid execution_backend. Options are: %s' %
+                (self.execution_backend, self.EXECUTION_BACKENDS)
+            )
+        if self.execution_backend == 'asyncssh':
+            try:
+                from djangostack.asyncssh_backend import AsyncSSHBackend
+            except (ImportError, SyntaxError):
+                raise InvalidArgumentException(
+                    'execution_backend asyncssh requires Python 3 and the asyncssh package.'
+                )
+            self.backend = AsyncSSHBackend(self.max_concurrent_commands)
+        self.confirm_redeploy = kwargs.get('confirm_redeploy', self.confirm_redeploy)
+        self.rolling_hosts = kwargs.get('rolling_hosts', self.rolling_hosts)
+        self.rolling_batch_size = kwargs.get('rolling_batch_size', self.rolling_batch_size)
+        self.load_balancer_host = kwargs.get('load_balancer_host', self.load_balancer_host)
+        self.load_balancer_type = kwargs.get('load_balancer_type', self.load_balancer_type)
+        self.load_balancer_servers = \
+            kwargs.get('load_balancer_servers', self.load_balancer_servers) or {}
+        self.haproxy_backend = kwargs.get('haproxy_backend', self.haproxy_backend)
+        self.haproxy_socket_path = kwargs.get('haproxy_socket_path', self.haproxy_socket_path)
+        self.nginx_upstream_config_path = \
+            kwargs.get('nginx_upstream_config_path', self.nginx_upstream_config_path)
+        if self.load_balancer_host:
+            if self.load_balancer_type not in self.LOAD_BALANCER_TYPES:
+                raise InvalidArgumentException(
+                    '%s is not a valid load_balancer_type. Options are: %s' %
+                    (self.load_balancer_type, self.LOAD_BALANCER_TYPES)
+                )
+            if self.load_balancer_type == 'haproxy' and not self.haproxy_backend:
+                raise InvalidArgumentException(
+                    'haproxy_backend must be specified if load_balancer_type is haproxy.'
+                )
+            if self.load_balancer_type == 'nginx' and not self.nginx_upstream_config_path:
+                raise InvalidArgumentException(
+                    'nginx_upstream_config_path must be specified if load_balancer_type is nginx.'
+                )
+        self.drain_seconds = kwargs.get('drain_seconds', self.drain_seconds)
+        self.health_check_url = kwargs.get('health_check_url', self.health_check_url)
+        self.health_check_retries = kwargs.get('health_check_retries', self.health_check_retries)
+        self.site_host = kwargs.get('site_host', self.site_host)
+        self.telemetry = kwargs.get('telemetry', self.telemetry)
+        self.telemetry_interval = kwargs.get('telemetry_interval', self.telemetry_interval)
+        self.telemetry_progress_interval = \
+            kwargs.get('telemetry_progress_interval', self.telemetry_progress_interval)
+        self.telemetry_export_dir = kwargs.get('telemetry_export_dir', self.telemetry_export_dir)
         self.verbosity = kwargs.get('verbosity', self.verbosity)
+        self.host_facts_max_age = kwargs.get('host_facts_max_age', self.host_facts_max_age)
         if self.deploy_django:
             if self.django_version_number != '':
                 self.python_dependencies.append('django==%s' % self.django_version_number)
@@ -134,12 +454,33 @@ class DjangoStack(TaskSet):
                         'specified if use_transifex is True.'
                     )
                 self.python_dependencies.append('transifex-client')
+
+            if self.deploy_cache:
+                if self.cache_type == 'redis':
+                    self.python_dependencies.append('django-redis')
+                elif self.cache_type == 'memcached':
+                    self.python_dependencies.append('pymemcache')
         self.repositories = []
         self.packages = []
         self.packages.extend(self.default_additional_packages)
         self.pre_build_hooks = []
         self.post_build_hooks = []
         self.post_checkout_hooks = []
+        self.rollback_hooks = []
+        self.plan = None  # Set to a DeployPlan while plan_stack is running
+        self.host_facts = {}
+        self.deploy_state = {}
+        self.stage_timings = {}
+        self.operation_timings = {}
+        self.stage_operations = {}
+        self._current_stage = None
+        self._package_proxy_log_start = 0
+        self._cache_config_changed = False
+        self.telemetry_samples = []
+        self.stage_telemetry = {}
+        self._telemetry_monitor = None
+        self._telemetry_lines = 0
+        self._telemetry_clock_offset = 0
 
     def add_additional_python_dependency(self, dependency):
         # Append python dependency to python installation list.
@@ -165,24 +506,35 @@ class DjangoStack(TaskSet):
         # Append func to post checkout task list.
         self.post_checkout_hooks.append(func)
 
+    def add_rollback_hook(self, func):
+        # Append func to the task list run when the load test fails with
+        # load_test_failure_action set to rollback.
+        self.rollback_hooks.append(func)
+
     def set_dir_attribs(self, dir_path, mode=None, owner=None, group=None, recursive=True):
         # Wrapper for calling fabric's dir_attribs function.
         with mode_sudo():
-            dir_attribs(dir_path, mode=mode, owner=owner, group=group, recursive=recursive)
+            recursive = '-R ' if recursive else ''
+            if mode:
+                self._run('chmod %s%s %s' % (recursive, mode, dir_path))
+            if owner:
+                self._run('chown %s%s %s' % (recursive, owner, dir_path))
+            if group:
+                self._run('chgrp %s%s %s' % (recursive, group, dir_path))
 
     def set_uid(self, dir_path, dirs=True, files=True):
         # Call setuid (or u+s) on directories and files under dir_path.
         if dirs:
-            sudo("find %s -type d -exec chmod u+s '{}' \;" % dir_path)
+            self._sudo("find %s -type d -exec chmod u+s '{}' \;" % dir_path)
         if files:
-            sudo("find %s -type f -exec chmod u+s '{}' \;" % dir_path)
+            self._sudo("find %s -type f -exec chmod u+s '{}' \;" % dir_path)
 
     def set_gid(self, dir_path, dirs=True, files=True):
         # Call setgid (or g+s) on directories and files under dir_path.
         if dirs:
-            sudo("find %s -type d -exec chmod g+s '{}' \;" % dir_path)
+            self._sudo("find %s -type d -exec chmod g+s '{}' \;" % dir_path)
         if files:
-            sudo("find %s -type f -exec chmod g+s '{}' \;" % dir_path)
+            self._sudo("find %s -type f -exec chmod g+s '{}' \;" % dir_path)
 
     def _validate_boolean_input(self, input):
         # Validate a boolean input (i.e. Yes or No).
@@ -190,41 +542,250 @@ class DjangoStack(TaskSet):
             raise InvalidArgumentException('Please enter y (yes) or n (no).')
         return input
 
+    def _remote(self, kind, description, func, *args, **kwargs):
+        # Single entry point for every mutating remote operation. While planning the
+        # operation is recorded against the current stage instead of being executed,
+        # otherwise it is executed and timed so the next plan can estimate its cost.
+        if self.plan is not None:
+            self.plan.add(self._current_stage, kind, description)
+            return ''
+        start = time.time()
+        result = func(*args, **kwargs)
+        key = operation_key(kind, description)
+        self.operation_timings[key] = round(time.time() - start, 2)
+        if self._current_stage is not None:
+            self.stage_operations.setdefault(self._current_stage, []).append(key)
+        return result
+
+    def _backend_run(self, command, sudo=False, user=None, pty=True):
+        # Run command through the execution backend, honouring cuisine's mode_sudo
+        # and fabric's warn_only like fabric's own run does.
+        return self.backend.run(
+            command, sudo=sudo or is_sudo(), user=user, warn_only=env.warn_only
+        )
+
+    def _run(self, command, kind='command', **kwargs):
+        # Mutating run (respects cuisine's mode_sudo).
+        if self.backend:
+            return self._remote(kind, command, self._backend_run, command, **kwargs)
+        return self._remote(kind, command, run, command, **kwargs)
+
+    def _sudo(self, command, kind='command', **kwargs):
+        # Mutating sudo.
+        if self.backend:
+            return self._remote(kind, command, self._backend_run, command, sudo=True, **kwargs)
+        return self._remote(kind, command, sudo, command, **kwargs)
+
+    def _put(self, local_path, remote_path, description=None, **kwargs):
+        # Upload a local file (or file-like object, given a description) to the host.
+        return self._remote(
+            'upload', description or '%s -> %s' % (local_path, remote_path),
+            self.backend.put if self.backend else put, local_path, remote_path, **kwargs
+        )
+
+    def _package_ensure(self, package_name):
+        # Ensure a system package is installed. Returns True if it was already
+        # installed, which while planning is answered from the cached host facts.
+        if self.plan is not None:
+            installed = fnmatch.filter(self.host_facts.get('packages', []), package_name)
+            if not installed:
+                self.plan.add(self._current_stage, 'package', package_name)
+            return bool(installed)
+        if self.backend:
+            installed = 'ok installed' in self._query(
+                "dpkg-query -W -f='${Status}\\n' '%s'" % package_name
+            )
+            if not installed:
+                self._remote(
+                    'package', package_name, self._backend_run,
+                    "DEBIAN_FRONTEND=noninteractive apt-get install -q -y '%s'" % package_name,
+                    sudo=True
+                )
+            return installed
+        return self._remote('package', package_name, package_ensure, package_name)
+
+    def _package_update(self):
+        # Update the system package lists.
+        if self.backend:
+            return self._remote(
+                'command', 'package_update', self._backend_run, 'apt-get update -q', sudo=True
+            )
+        return self._remote('command', 'package_update', package_update)
+
+    def _exists(self, path):
+        # Whether path exists on the host.
+        return self._query('test -e %s && echo yes' % path) == 'yes'
+
+    def _dir_exists(self, path):
+        # Whether path is a directory on the host.
+        return self._query('test -d %s && echo yes' % path) == 'yes'
+
+    def _contains(self, path, text):
+        # Whether the file at path contains text.
+        return self._query('grep -qF %s %s && echo yes' % (shell_quote(text), path)) == 'yes'
+
+    def _contains_line(self, path, line):
+        # Whether the file at path contains line as a whole line.
+        return self._query('grep -qxF %s %s && echo yes' % (shell_quote(line), path)) == 'yes'
+
+    def _append(self, path, lines):
+        # Append each of lines to the file at path, unless it already holds it.
+        for line in lines:
+            line = shell_quote(line)
+            self._run('grep -qxF %s %s || echo %s >> %s' % (line, path, line, path))
+
+    def _pip_requirement_installed(self, requirement):
+        # Whether a requirement such as 'uwsgi' or 'django==1.8' is satisfied by the
+        # system python packages in the cached host facts. Requirement files and
+        # other version specifiers are never considered satisfied.
+        match = re.match(r'^([A-Za-z0-9_.\-]+)(?:==([^\s,;]+))?$', requirement.strip())
+        if not match:
+            return False
+        installed = dict(
+            line.lower().replace('_', '-').split('==', 1)
+            for line in self.host_facts.get('python_packages', []) if '==' in line
+        )
+        version = installed.get(match.group(1).lower().replace('_', '-'))
+        return version is not None and (match.group(2) or version).lower() == version
+
+    def _pip_install(self, requirement, pip='pip'):
+        # Install a python dependency with pip, through the PyPI caching proxy when
+        # package_proxy_host is set. While planning, system wide requirements that
+        # the cached host facts show installed are left out of the plan.
+        if self.plan is not None and pip == 'pip' and self._pip_requirement_installed(requirement):
+            return ''
+        if self.package_proxy_host:
+            address = host_name(self.package_proxy_host)
+            requirement = '--index-url http://%s:%s/root/pypi/+simple/ --trusted-host %s %s' % (
+                address, self.pip_proxy_port, address, requirement
+            )
+        return self._sudo('%s install %s' % (pip, requirement), kind='package')
+
+    def _python_bin(self, name='python'):
+        # Path of a python executable (python, pip, tx...) the project runs with.
+        if self.use_virtualenv:
+            return '%scurrent/bin/%s' % (self.virtualenv_root, name)
+        return name
+
+    def _query(self, command):
+        # Run a read-only command and return its output. Queries are always executed,
+        # including while planning, and never abort the deployment.
+        if self.backend:
+            return self.backend.run(command, sudo=is_sudo(), warn_only=True, quiet=True)
+        with settings(hide('everything'), warn_only=True):
+            return run(command)
+
+    def _load_deploy_state(self):
+        # Read the deploy state left on the host by the previous deployment.
+        try:
+            return json.loads(self._query('cat %s' % self.deploy_state_path) or '{}')
+        except ValueError:
+            return {}
+
+    def _save_deploy_state(self):
+        # Write the deploy state for this deployment to the host.
+        self._put(
+            StringIO(json.dumps(self.deploy_state, indent=2, sort_keys=True)),
+            self.deploy_state_path, description='deploy state -> %s' % self.deploy_state_path,
+            use_sudo=True
+        )
+
+    def _load_host_facts(self):
+        # Return the cached facts for the current host, gathering them if the local
+        # cache holds nothing for it yet or they are older than host_facts_max_age.
+        facts = {}
+        if os.path.exists(self.host_facts_name):
+            with open(self.host_facts_name) as facts_file:
+                facts = json.load(facts_file)
+        host_facts = facts.get(env.host_string)
+        if not host_facts or 'gathered_at' not in host_facts:
+            return self.gather_host_facts()
+        if self.host_facts_max_age is not None:
+            age = datetime.datetime.now() - datetime.datetime.strptime(
+                host_facts['gathered_at'].split('.')[0], '%Y-%m-%dT%H:%M:%S'
+            )
+            if age.days * 86400 + age.seconds > self.host_facts_max_age:
+                return self.gather_host_facts()
+        return host_facts
+
+    @task_method
+    def gather_host_facts(self):
+        # Collect read-only facts about the current host and cache them locally in
+        # host_facts_name for plan_stack.
+        packages = self._query("dpkg-query -W -f='${Status} ${Package}\\n'")
+        memory_kb = self._query("awk '/MemTotal/ {print $2}' /proc/meminfo")
+        host_facts = {
+            'packages': [
+                line.split()[-1] for line in packages.splitlines()
+                if line.startswith('install ok installed')
+            ],
+            'python_packages': self._query('pip freeze').splitlines(),
+            'cpu_count': int(self._query('nproc') or 1),
+            'memory_mb': int(memory_kb or 0) // 1024,
+            'gathered_at': datetime.datetime.now().isoformat(),
+        }
+        facts = {}
+        if os.path.exists(self.host_facts_name):
+            with open(self.host_facts_name) as facts_file:
+                facts = json.load(facts_file)
+        facts[env.host_string] = host_facts
+        with open(self.host_facts_name, 'w') as facts_file:
+            json.dump(facts, facts_file, indent=2, sort_keys=True)
+        return host_facts
+
     def _pre_build(self):
         # Internal pre build function that checks if DjangoStack has been deployed
-        # on the target server before. Prompts for confirmation to proceed if it has.
+        # on the target server before. Prompts for confirmation to proceed if it has
+        # and confirm_redeploy is True. The previous data file is removed either way,
+        # for _post_build to write this deployment's.
+        self.deploy_state = self._load_deploy_state()
         with mode_sudo():
-            if exists('~/.djangostack'):
+            if not self._deployed_before():
+                return
+            if self.confirm_redeploy:
                 print('\nIt appears that DjangoStack has been deployed to this server before:')
-                run('cat ~/.djangostack')
+                print(self._query('cat ~/.djangostack'))
                 deploy = prompt(
                     'Are you sure you wish to continue? [y/n]',
                     validate=self._validate_boolean_input
                 )
-                if deploy.lower() == 'y':
-                    run('rm ~/.djangostack')
-                else:
+                if deploy.lower() != 'y':
                     abort('DjangoStack deployment aborted.')
+            self._run('rm ~/.djangostack')
+
+    def _deployed_before(self):
+        # Whether DjangoStack has been deployed to the current host before.
+        with mode_sudo():
+            return self._exists('~/.djangostack')
 
     def _post_build(self):
         # Internal post build function that creates a data file containing the
         # build timestamp and some build data. The created file is used primarily
-        # by _pre_build.
+        # by _pre_build. The stage and operation timings of this run are saved to
+        # the deploy state for plan_stack.
         now = datetime.datetime.now()
-        sudo('touch ~/.djangostack')
-        append(
-            '~/.djangostack',
-            [
-                'Deployed on: %s at %s' % (now.strftime('%d/%m/%Y'), now.strftime('%H:%M:%S')),
-                'SCM Deployed: %s' % self.deploy_scm,
-                'Database Deployed: %s' % self.deploy_database,
-                'Postgis Deployed: %s' % self.deploy_postgis,
-                'Django Deployed: %s' % self.deploy_django,
-                'Web Server Deployed: %s' % self.deploy_web_server,
-                'Database Restored: %s' % self.restore_database
-            ],
-            use_sudo=True
-        )
+        self._sudo('touch ~/.djangostack')
+        with mode_sudo():
+            self._append(
+                '~/.djangostack',
+                [
+                    'Deployed on: %s at %s' % (now.strftime('%d/%m/%Y'), now.strftime('%H:%M:%S')),
+                    'SCM Deployed: %s' % self.deploy_scm,
+                    'Database Deployed: %s' % self.deploy_database,
+                    'Postgis Deployed: %s' % self.deploy_postgis,
+                    'Django Deployed: %s' % self.deploy_django,
+                    'Web Server Deployed: %s' % self.deploy_web_server,
+                    'Cache Deployed: %s' % self.deploy_cache,
+                    'Database Restored: %s' % self.restore_database
+                ]
+            )
+        self.deploy_state.update({
+            'deployed_at': now.isoformat(),
+            'stage_timings': self.stage_timings,
+            'operation_timings': self.operation_timings,
+            'stage_operations': self.stage_operations,
+        })
+        self._save_deploy_state()
 
     def _update_repository_permissions(self):
         # Processes the kwargs for each item in self.repositories and sets directory/file
@@ -246,9 +807,279 @@ class DjangoStack(TaskSet):
     @task_method(default=True)
     def setup_stack(self):
         # The mother function, deploy DjangoStack.
+        try:
+            self._setup_stack()
+        finally:
+            self._close_backend()
+
+    def _setup_stack(self):
         self._pre_build()
+        self._start_telemetry()
+        try:
+            self._build()
+        finally:
+            self._stop_telemetry()
+        self._post_build()
 
-        package_update()
+    def _start_telemetry(self):
+        # Start sampling the host's resources in the background, and a monitor thread
+        # printing a progress line for long stages.
+        if not self.telemetry:
+            return
+        script_path = '/tmp/djangostack_telemetry.py'
+        self._put(os.path.join(os.path.dirname(__file__), 'telemetry.py'), script_path)
+        self._run('rm -f %s' % TELEMETRY_SAMPLES_PATH)
+        self._run(
+            'nohup $(command -v python3 || command -v python) %s --interval %s --output %s '
+            '> /dev/null 2>&1 & echo $! > %s' % (
+                script_path, self.telemetry_interval, TELEMETRY_SAMPLES_PATH, TELEMETRY_PID_PATH
+            ),
+            pty=False
+        )
+        remote_time = self._query('date +%s.%N')
+        self._telemetry_clock_offset = float(remote_time) - time.time() if remote_time else 0
+        self.telemetry_samples = []
+        self.stage_telemetry = {}
+        self._telemetry_lines = 0
+        self._telemetry_monitor = TelemetryMonitor(
+            env.host_string, self._latest_telemetry_sample, self.telemetry_progress_interval
+        )
+        self._telemetry_monitor.start()
+
+    def _latest_telemetry_sample(self, host_string):
+        # Return the host's latest telemetry sample. This is called from the monitor
+        # thread, so it opens its own channel instead of going through fabric's run,
+        # which is not thread safe.
+        command = 'tail -n 1 %s' % TELEMETRY_SAMPLES_PATH
+        if self.backend:
+            line = self.backend.run(command, warn_only=True, quiet=True, host_string=host_string)
+        else:
+            stdin, stdout, stderr = connections[host_string].exec_command(command)
+            line = stdout.read().decode('utf-8')
+        return json.loads(line) if line.strip() else None
+
+    def _collect_telemetry(self):
+        # Fetch the samples taken since the last collection.
+        lines = self._query('tail -n +%s %s' % (self._telemetry_lines + 1, TELEMETRY_SAMPLES_PATH))
+        for line in lines.splitlines():
+            if line.strip():
+                self.telemetry_samples.append(json.loads(line))
+                self._telemetry_lines += 1
+
+    def _stage_telemetry(self, stage_name, start, end):
+        # Summarise the samples taken while a stage ran and report what bound it.
+        self._collect_telemetry()
+        start += self._telemetry_clock_offset
+        end += self._telemetry_clock_offset
+        summary = summarise([
+            sample for sample in self.telemetry_samples if start <= sample['time'] <= end
+        ])
+        line = '[%s] %s done in %.1fs' % (env.host_string, stage_name, end - start)
+        if summary:
+            summary.update({'start': round(start, 2), 'end': round(end, 2)})
+            self.stage_telemetry[stage_name] = summary
+            line += ', %s bound: %s' % (summary['bound'], describe(summary))
+        print(line)
+
+    def _stop_telemetry(self):
+        # Stop the sampler and the monitor, then export the samples and per stage
+        # summaries with the stage timings to <telemetry_export_dir>/<host>.json.
+        # The summaries are also kept in the deploy state. What was collected is
+        # exported even if the host can no longer be reached.
+        if not self._telemetry_monitor:
+            return
+        self._telemetry_monitor.stop()
+        self._telemetry_monitor = None
+        try:
+            self._run('kill $(cat %s) 2> /dev/null; rm -f %s' % (
+                TELEMETRY_PID_PATH, TELEMETRY_PID_PATH
+            ))
+            self._collect_telemetry()
+        except (Exception, SystemExit) as e:
+            warn('Could not stop the telemetry sampler: %s' % e)
+        self.deploy_state['stage_telemetry'] = self.stage_telemetry
+        if not os.path.isdir(self.telemetry_export_dir):
+            os.makedirs(self.telemetry_export_dir)
+        export_path = os.path.join(
+            self.telemetry_export_dir, '%s.json' % host_name(env.host_string)
+        )
+        with open(export_path, 'w') as export_file:
+            json.dump({
+                'host': env.host_string,
+                'stage_timings': self.stage_timings,
+                'stage_telemetry': self.stage_telemetry,
+                'samples': self.telemetry_samples,
+            }, export_file, indent=2, sort_keys=True)
+
+    @task_method
+    def plan_stack(self):
+        # Print the ordered remote operations setup_stack would perform on the host,
+        # each with a cost estimated from the previous run's timings. Stages are
+        # evaluated against the cached host facts and the deploy state; only
+        # read-only queries are executed.
+        self.deploy_state = self._load_deploy_state()
+        self.host_facts = self._load_host_facts()
+        self.plan = DeployPlan(
+            self.deploy_state.get('operation_timings'), self.deploy_state.get('stage_timings'),
+            self.deploy_state.get('stage_operations')
+        )
+        try:
+            self._build()
+        finally:
+            plan, self.plan = self.plan, None
+        for line in plan.render(env.host_string):
+            print(line)
+        return plan
+
+    @task_method
+    @runs_once
+    def rolling_deploy(self):
+        # Deploy rolling_hosts (or every host of the fab run) in batches of
+        # rolling_batch_size. Each batch is drained from the load balancer, deployed
+        # in parallel, health checked and put back before the next batch starts.
+        # Migrations run exactly once: the first host is deployed on its own, with
+        # migrations, before the batches and the rest are deployed without them.
+        # Any failure stops the rollout, leaving the failed batch drained.
+        # Fabric cannot prompt from parallel hosts, so confirm_redeploy is asked
+        # once here for every host and turned off for the batches.
+        hosts = list(self.rolling_hosts or env.all_hosts)
+        if not hosts:
+            abort('No hosts to deploy to.')
+        if self.confirm_redeploy:
+            deployed = [
+                host for host, deployed in execute(self._deployed_before, hosts=hosts).items()
+                if deployed
+            ]
+            if deployed:
+                print('\nIt appears that DjangoStack has been deployed to these servers before: %s' %
+                      ', '.join(sorted(deployed)))
+                deploy = prompt(
+                    'Are you sure you wish to continue? [y/n]',
+                    validate=self._validate_boolean_input
+                )
+                if deploy.lower() != 'y':
+                    abort('DjangoStack deployment aborted.')
+        if self.package_proxy_host and self.deploy_package_proxy:
+            execute(self.setup_package_proxy, hosts=[self.package_proxy_host])
+        run_migrations, confirm_redeploy = self.run_migrations, self.confirm_redeploy
+        self.confirm_redeploy = False
+        batches = [hosts[:1]] + self._rolling_batches(hosts[1:])
+        try:
+            for number, batch in enumerate(batches):
+                print('\nDeploying batch %s of %s: %s' % (number + 1, len(batches), ', '.join(batch)))
+                self.run_migrations = run_migrations and number == 0
+                self._set_load_balancer_state(batch, 'drain')
+                execute(parallel(pool_size=len(batch))(self._deploy_node), hosts=batch)
+                self._set_load_balancer_state(batch, 'ready')
+        finally:
+            self.run_migrations, self.confirm_redeploy = run_migrations, confirm_redeploy
+            self._close_backend()
+
+    def _rolling_batches(self, hosts):
+        # Split hosts into batches of rolling_batch_size hosts.
+        batch_size = str(self.rolling_batch_size)
+        if batch_size.endswith('%'):
+            batch_size = int(math.ceil(len(hosts) * float(batch_size[:-1]) / 100))
+        batch_size = max(int(batch_size), 1)
+        return [hosts[i:i + batch_size] for i in range(0, len(hosts), batch_size)]
+
+    def _deploy_node(self):
+        # Deploy the current host and health check it.
+        try:
+            self._setup_stack()
+            self.health_check()
+        finally:
+            self._close_backend()
+
+    def _close_backend(self):
+        # Close the execution backend's connections, if it keeps any.
+        if self.backend:
+            self.backend.close()
+
+    def run_on_hosts(self, command, hosts=None, use_sudo=False):
+        # Run command on every host (all hosts of the fab run by default) at once and
+        # return {host: output}. With the asyncssh backend every host is driven from
+        # this process over its shared connection, otherwise Fabric forks a process
+        # per host.
+        hosts = list(hosts or env.all_hosts)
+        if self.backend:
+            return self.backend.run_many(hosts, command, sudo=use_sudo)
+        return execute(parallel(self._run_command), command, use_sudo, hosts=hosts)
+
+    def _run_command(self, command, use_sudo):
+        return sudo(command) if use_sudo else run(command)
+
+    def _site_host(self):
+        # The host name the site answers to: site_host, or else the first
+        # nginx_server_name unless it is the catch-all _. None if neither is set.
+        if self.site_host:
+            return self.site_host
+        server_names = (self.nginx_server_name or '').split()
+        if server_names and server_names[0] != '_':
+            return server_names[0]
+        return None
+
+    def health_check(self):
+        # Abort unless health_check_url responds successfully on the current host,
+        # requested with the site's Host header so that ALLOWED_HOSTS accepts it.
+        host_header = ''
+        if self._site_host():
+            host_header = '-H %s ' % shell_quote('Host: %s' % self._site_host())
+        for attempt in range(self.health_check_retries):
+            result = self._query('curl -fsS -o /dev/null -m 10 %s%s' % (
+                host_header, shell_quote('http://127.0.0.1%s' % self.health_check_url)
+            ))
+            if result.succeeded:
+                return
+            time.sleep(3)
+        abort('Health check of %s failed.' % env.host_string)
+
+    def _set_load_balancer_state(self, hosts, state):
+        # Drain hosts from the load balancer, or put them back with state 'ready'.
+        if not self.load_balancer_host:
+            return
+        servers = [
+            self.load_balancer_servers.get(host, host_name(host))
+            for host in hosts
+        ]
+        execute(self._set_load_balancer_servers_state, servers, state,
+                hosts=[self.load_balancer_host])
+        if state == 'drain':
+            time.sleep(self.drain_seconds)
+
+    def _set_load_balancer_servers_state(self, servers, state):
+        # Run on the load balancer host by _set_load_balancer_state.
+        with mode_sudo():
+            if self.load_balancer_type == 'haproxy':
+                for server in servers:
+                    self._run("echo 'set server %s/%s state %s' | socat stdio %s" % (
+                        self.haproxy_backend, server, state, self.haproxy_socket_path
+                    ))
+            elif self.load_balancer_type == 'nginx':
+                for server in servers:
+                    address = re.escape(server)
+                    self._run("sed -i -E 's/^(\\s*server\\s+%s\\b[^;]*) down;/\\1;/' %s" % (
+                        address, self.nginx_upstream_config_path
+                    ))
+                    if state == 'drain':
+                        self._run("sed -i -E 's/^(\\s*server\\s+%s\\b[^;]*);/\\1 down;/' %s" % (
+                            address, self.nginx_upstream_config_path
+                        ))
+                self._run('nginx -s reload', kind='service')
+
+    def _build(self):
+        # Every deployment stage, in order, with the package caching proxy configured
+        # on the host for the duration of the run.
+        if self.package_proxy_host:
+            self.configure_package_proxy()
+        try:
+            self._build_stages()
+        finally:
+            if self.package_proxy_host:
+                self.remove_package_proxy()
+
+    def _build_stages(self):
+        self.update_packages()
 
         self.run_pre_build_hooks()
 
@@ -258,6 +1089,9 @@ class DjangoStack(TaskSet):
         if self.deploy_database:
             self.setup_postgres()
 
+        if self.deploy_cache and not self.cache_host:
+            self.setup_cache()
+
         self.setup_additional_packages()
         self.setup_python()
 
@@ -276,7 +1110,11 @@ class DjangoStack(TaskSet):
             self.checkout_code()
 
         if self.deploy_django:
-            self.install_django_project_requirements()
+            if not self.use_virtualenv:
+                self.install_django_project_requirements()
+
+        if self.use_virtualenv:
+            self.setup_virtualenv()
 
         if self.deploy_web_server:
             self.setup_web_server()
@@ -293,115 +1131,395 @@ class DjangoStack(TaskSet):
             self.make_and_compile_messages(use_transifex=self.use_transifex)
 
         self.run_post_build_hooks()
-        self._update_repository_permissions()
+        self.update_repository_permissions()
         self.restart_services()
-        self._post_build()
 
+        if self.warmup_urls:
+            self.warm_up()
+
+    @task_method
+    def setup_package_proxy(self):
+        # Stand up an apt-cacher-ng apt proxy and a devpi-server PyPI mirror on the
+        # current host, to be used by other hosts through package_proxy_host.
+        self._package_ensure('apt-cacher-ng')
+        self._package_ensure('python-pip')
+        self._sudo('pip install devpi-server', kind='package')
+        with mode_sudo():
+            with warn_only():
+                # Fails harmlessly if the server directory is already initialised.
+                self._run('devpi-init')
+            # Check the port rather than pgrep -f, which matches the shell running
+            # this very command line.
+            self._run(
+                "ss -ltn | grep -q ':%s ' || nohup devpi-server --host 0.0.0.0 --port %s "
+                "> /var/log/devpi-server.log 2>&1 &" % (self.pip_proxy_port, self.pip_proxy_port),
+                pty=False
+            )
+
+    def _package_proxy_counters(self, client=None):
+        # Return the apt-cacher-ng log length and the bytes fetched from upstream
+        # (I) and delivered (O) for client, the deployed host's address, since this
+        # run started. Run on the proxy. Without a client every host's traffic counts.
+        log_path = '/var/log/apt-cacher-ng/apt-cacher.log'
+        client_filter = '$4==\"%s\" && ' % client if client else ''
+        with mode_sudo():
+            lines = int(self._query('cat %s | wc -l' % log_path) or 0)
+            counters = self._query(
+                "tail -n +%s %s | awk -F'|' '%s$2==\"I\" {i+=$3} %s$2==\"O\" {o+=$3} "
+                "END {print i+0, o+0}'" % (
+                    self._package_proxy_log_start + 1, log_path, client_filter, client_filter
+                )
+            ).split()
+        return lines, [int(float(counter)) for counter in counters or [0, 0]]
+
+    def _package_proxy_client(self):
+        # The address the host connects to package_proxy_host from, which is the
+        # client address apt-cacher-ng logs for it. None if it cannot be found.
+        address = self._query(
+            "ip -o route get $(getent ahostsv4 %s | awk 'NR==1 {print $1}') | "
+            "sed -n 's/.* src \\([0-9.]*\\).*/\\1/p'" % host_name(self.package_proxy_host)
+        ).strip()
+        return address if re.match(r'^[0-9.]+$', address) else None
+
+    @stage
+    def configure_package_proxy(self):
+        # Point apt on the host at package_proxy_host for the run (pip is pointed at it
+        # by _pip_install).
+        with mode_sudo():
+            self._run(
+                "echo 'Acquire::http::Proxy \"http://%s:%s\";' > %s" % (
+                    host_name(self.package_proxy_host), self.apt_proxy_port,
+                    '/etc/apt/apt.conf.d/01djangostack-proxy'
+                )
+            )
+        if self.plan is None:
+            self._package_proxy_log_start = 0
+            self._package_proxy_log_start = execute(
+                self._package_proxy_counters, hosts=[self.package_proxy_host]
+            )[self.package_proxy_host][0]
+
+    @stage
+    def remove_package_proxy(self):
+        # Remove the apt proxy configuration and report the apt cache hit rate of the
+        # host's requests during the run, by bytes. This runs after a failed stage
+        # too, so the report must not replace that stage's exception.
+        with mode_sudo():
+            self._run('rm -f /etc/apt/apt.conf.d/01djangostack-proxy')
+        if self.plan is not None:
+            return
+        try:
+            client = self._package_proxy_client()
+            lines, (fetched, delivered) = execute(
+                self._package_proxy_counters, client, hosts=[self.package_proxy_host]
+            )[self.package_proxy_host]
+            if delivered:
+                print('Package proxy apt cache hit rate: %.0f%% (%s of %s bytes from cache)' % (
+                    100.0 * (delivered - fetched) / delivered, delivered - fetched, delivered
+                ))
+        except (Exception, SystemExit) as e:
+            warn('Could not report the package proxy hit rate: %s' % e)
+
+    @stage
+    def update_packages(self):
+        # Update the system package lists, unless they are younger than
+        # package_lists_max_age.
+        if self.package_lists_max_age:
+            age = self._query('echo $(( $(date +%s) - $(stat -c %Y /var/lib/apt/lists) ))')
+            if age.isdigit() and int(age) < self.package_lists_max_age:
+                return
+        self._package_update()
+
+    @stage
     def run_pre_build_hooks(self):
         # Execute all external pre build functions.
         for hook in self.pre_build_hooks:
-            hook()
+            self._remote('hook', getattr(hook, '__name__', repr(hook)), hook)
 
+    @stage
     def setup_scm(self):
         # Set up the SCM.
         if self.scm_type == 'mercurial':
-            package_ensure('mercurial')
+            self._package_ensure('mercurial')
         elif self.scm_type.lower() == 'git':
-            package_ensure('git')
+            self._package_ensure('git')
 
     def setup_postgis(self):
         # Set up postgis
-        package_ensure('postgis*')
+        self._package_ensure('postgis*')
 
+    @stage
     def setup_postgres(self):
         # Set up postgresql.
-        package_ensure('postgresql')
-        package_ensure('postgresql-client')
-        package_ensure('libpq-dev')
+        self._package_ensure('postgresql')
+        self._package_ensure('postgresql-client')
+        self._package_ensure('libpq-dev')
         if self.deploy_postgis:
             self.setup_postgis()
 
     def setup_postgis_for_database(self):
         # Install the postgis extensions.
         if self.deploy_postgis:
-            sudo('psql -d {0} -c "CREATE EXTENSION  IF NOT EXISTS postgis;" -d {0}'.format(self.database_name), user='postgres')
-            sudo('psql -d {0} -c "CREATE EXTENSION  IF NOT EXISTS fuzzystrmatch;" -d {0}'.format(self.database_name), user='postgres')
-            sudo('psql -d {0} -c "CREATE EXTENSION  IF NOT EXISTS postgis_topology;" -d {0}'.format(self.database_name), user='postgres')
-            sudo('psql -d {0} -c "CREATE EXTENSION  IF NOT EXISTS postgis_tiger_geocoder;" -d {0}'.format(self.database_name), user='postgres')
+            self._sudo('psql -d {0} -c "CREATE EXTENSION  IF NOT EXISTS postgis;" -d {0}'.format(self.database_name), kind='database', user='postgres')
+            self._sudo('psql -d {0} -c "CREATE EXTENSION  IF NOT EXISTS fuzzystrmatch;" -d {0}'.format(self.database_name), kind='database', user='postgres')
+            self._sudo('psql -d {0} -c "CREATE EXTENSION  IF NOT EXISTS postgis_topology;" -d {0}'.format(self.database_name), kind='database', user='postgres')
+            self._sudo('psql -d {0} -c "CREATE EXTENSION  IF NOT EXISTS postgis_tiger_geocoder;" -d {0}'.format(self.database_name), kind='database', user='postgres')
             with mode_sudo():
-                if not exists('/usr/local/lib/libgeos_c.so'):
-                    run('ln -s /usr/lib/libgeos_c.so.1 /usr/local/lib/libgeos_c.so')
+                if not self._exists('/usr/local/lib/libgeos_c.so'):
+                    self._run('ln -s /usr/lib/libgeos_c.so.1 /usr/local/lib/libgeos_c.so')
+
+    def _host_memory_mb(self):
+        # Total memory of the host in MB, from the host facts when they are loaded.
+        if 'memory_mb' in self.host_facts:
+            return self.host_facts['memory_mb']
+        return int(self._query("awk '/MemTotal/ {print $2}' /proc/meminfo") or 0) // 1024
+
+    def _host_cpu_count(self):
+        # Number of CPUs on the host, from the host facts when they are loaded.
+        if 'cpu_count' in self.host_facts:
+            return self.host_facts['cpu_count']
+        return int(self._query('nproc') or 1)
+
+    def _nginx_site_config(self):
+        # Render the generated nginx site configuration from NGINX_SITE_TEMPLATE.
+        context = {
+            'name': re.sub(r'\W', '_', self.project_name),
+            'uwsgi_socket': self.uwsgi_socket,
+            'uwsgi_params_path': self.uwsgi_params_path,
+            'server_name': self.nginx_server_name,
+            'client_max_body_size': self.nginx_client_max_body_size,
+            'static_url': self.nginx_static_url,
+            'static_path': self.django_static_path,
+            'micro_cache_seconds': self.nginx_micro_cache_seconds,
+            'http_extra': '',
+            'static': '',
+            'micro_cache': '',
+        }
+        if self.django_static_path:
+            context['http_extra'] += NGINX_STATIC_HTTP_TEMPLATE % context
+            context['static'] = NGINX_STATIC_TEMPLATE % context
+        if self.nginx_micro_cache_seconds:
+            context['http_extra'] += NGINX_MICRO_CACHE_HTTP_TEMPLATE % context
+            context['micro_cache'] = NGINX_MICRO_CACHE_TEMPLATE % context
+        return NGINX_SITE_TEMPLATE % context
+
+    def _tune_nginx(self):
+        # Size nginx's workers to the host: one worker per CPU and, unless
+        # nginx_worker_connections is given, worker_connections from the host's
+        # memory and open file limit (see nginx_worker_connections).
+        # worker_rlimit_nofile raises the workers' own descriptor limit to match,
+        # rather than relying on the limit nginx was started with.
+        cpu_count = self._host_cpu_count()
+        worker_connections = self.nginx_worker_connections
+        if not worker_connections:
+            limits = self._query('cat /proc/sys/fs/file-max /proc/sys/fs/nr_open').split()
+            open_files = None
+            if len(limits) == 2 and all(limit.isdigit() for limit in limits):
+                open_files = min(int(limits[0]) // cpu_count, int(limits[1]))
+            worker_connections = nginx_worker_connections(
+                self._host_memory_mb(), cpu_count, open_files
+            )
+        self._run(
+            "sed -i -e '/^\\s*worker_rlimit_nofile /d' "
+            "-e 's/^\\s*worker_processes .*/worker_processes %s;\\nworker_rlimit_nofile %s;/' "
+            "/etc/nginx/nginx.conf" % (cpu_count, worker_connections * 2)
+        )
+        self._run(
+            "sed -i 's/^\\s*worker_connections .*/\\tworker_connections %s;/' "
+            "/etc/nginx/nginx.conf" % worker_connections
+        )
 
+    def _cache_settings(self):
+        # Django settings lines pointing the cache framework and sessions at the cache
+        # tier, on cache_host when given. Sessions default to cached_db, which keeps
+        # them in the database too, so they survive evictions and cache restarts.
+        address = '127.0.0.1'
+        if self.cache_host:
+            address = self.cache_listen_address or host_name(self.cache_host)
+        if self.cache_type == 'redis':
+            backend = 'django_redis.cache.RedisCache'
+            password = ':%s@' % url_quote(self.cache_password, safe='') if self.cache_password else ''
+            location = 'redis://%s%s:6379/1' % (password, address)
+        else:
+            backend = 'django.core.cache.backends.memcached.PyMemcacheCache'
+            location = '%s:11211' % address
+        return [
+            "CACHES = {'default': {'BACKEND': '%s', 'LOCATION': '%s'}}" % (backend, location),
+            "SESSION_ENGINE = '%s'" % self.session_engine,
+        ]
+
+    @stage
+    def setup_cache(self, listen_address='127.0.0.1'):
+        # Install the cache server, limit its memory and bind it to listen_address.
+        # Unless cache_memory_mb is given, the cache is allowed a quarter of the
+        # host's memory (at least 64MB). Redis requires cache_password when it is
+        # given. The configuration is only rewritten when it differs, and
+        # restart_services only restarts the server if it was, as a restart empties
+        # the cache.
+        memory_mb = self.cache_memory_mb or max(self._host_memory_mb() // 4, 64)
+        self._cache_config_changed = False
+        if self.cache_type == 'redis':
+            package_name, config_path = 'redis-server', '/etc/redis/redis.conf'
+            lines = [
+                'bind %s' % listen_address,
+                'protected-mode yes',
+                'maxmemory %smb' % memory_mb,
+                'maxmemory-policy %s' % self.cache_eviction_policy,
+            ]
+            if self.cache_password:
+                lines.append('requirepass %s' % self.cache_password)
+            patterns = ['^#\\? *bind ', '^#\\? *protected-mode ', '^#\\? *maxmemory ',
+                        '^#\\? *maxmemory-policy ', '^#\\? *requirepass ']
+        elif self.cache_type == 'memcached':
+            package_name, config_path = 'memcached', '/etc/memcached.conf'
+            lines = ['-m %s' % memory_mb, '-l %s' % listen_address]
+            patterns = ['^-m ', '^-l ']
+        else:
+            return
+        with mode_sudo():
+            self._package_ensure(package_name)
+            if not all(self._contains_line(config_path, line) for line in lines):
+                self._run("sed -i %s %s" % (
+                    ' '.join("-e '/%s/d'" % pattern for pattern in patterns), config_path
+                ))
+                self._run("printf '%%s\\n' %s >> %s" % (
+                    ' '.join(shell_quote(line) for line in lines), config_path
+                ))
+                self._cache_config_changed = True
+
+    def _restart_cache(self):
+        if self.cache_type == 'redis':
+            self._run('service redis-server restart', kind='service')
+        elif self.cache_type == 'memcached':
+            self._run('service memcached restart', kind='service')
+
+    @task_method
+    def setup_cache_host(self):
+        # Set up the cache server on the current host, listening on its private
+        # cache_listen_address, to be shared by other deployments through cache_host.
+        if not self.cache_listen_address:
+            raise InvalidArgumentException(
+                'cache_listen_address must be specified to set up a cache host.'
+            )
+        if self.cache_type == 'redis' and not self.cache_password:
+            raise InvalidArgumentException(
+                'cache_password must be specified to set up a redis cache host.'
+            )
+        self.setup_cache(listen_address=self.cache_listen_address)
+        if self._cache_config_changed:
+            self._restart_cache()
+
+    @stage
     def setup_additional_packages(self):
         # Install all additional system packages.
         for package_name in self.packages:
-            package_ensure(package_name)
+            self._package_ensure(package_name)
 
+    @stage
     def setup_python(self):
-        # Install python and all python dependencies.
-        package_ensure('build-essential')
-        package_ensure('python')
-        package_ensure('python-dev')
-        package_ensure('python-pip')
+        # Install python and all python dependencies. If use_virtualenv is True the
+        # dependencies are installed later by setup_virtualenv instead.
+        self._package_ensure('build-essential')
+        self._package_ensure('python')
+        self._package_ensure('python-dev')
+        self._package_ensure('python-pip')
+
+        if self.use_virtualenv:
+            self._package_ensure('python-virtualenv')
+            return
 
         for dependency in self.python_dependencies:
-            sudo('pip install %s' % dependency)
+            self._pip_install(dependency)
 
+    @stage
     def setup_apache(self, destroy_nginx=True):
         # Setup apache2.
         if destroy_nginx:
             with mode_sudo():
                 with warn_only():
-                    run('service nginx stop')
-                    run('/usr/bin/yes | sudo pip uninstall uwsgi')
-                    run('apt-get -y purge nginx nginx-common')
-                run('apt-get -y autoremove')
+                    self._run('service nginx stop', kind='service')
+                    self._run('/usr/bin/yes | sudo pip uninstall uwsgi')
+                    self._run('apt-get -y purge nginx nginx-common')
+                self._run('apt-get -y autoremove')
 
-        had_apache = package_ensure('apache2')
-        package_ensure('libapache2-mod-python')
-        package_ensure('libapache2-mod-wsgi')
-        sudo('a2enmod rewrite')
+        had_apache = self._package_ensure('apache2')
+        self._package_ensure('libapache2-mod-python')
+        self._package_ensure('libapache2-mod-wsgi')
+        self._sudo('a2enmod rewrite')
 
         if not had_apache and hasattr(env, 'vagrant_mode'):
-            local('vagrant reload')
-            time.sleep(15)
+            self._remote('command', 'vagrant reload', local, 'vagrant reload')
+            if self.plan is None:
+                time.sleep(15)
 
+    @stage
     def setup_nginx(self, destroy_apache=True):
         # Setup nginx.
         if destroy_apache:
             with mode_sudo():
                 with warn_only():
-                    run('service apache2 stop')
-                    run('apt-get -y purge apache2 apache2-utils apache2.2-bin apache2-common')
-                run('apt-get -y autoremove')
+                    self._run('service apache2 stop', kind='service')
+                    self._run('apt-get -y purge apache2 apache2-utils apache2.2-bin apache2-common')
+                self._run('apt-get -y autoremove')
 
-        package_ensure('nginx')
-        sudo('pip install uwsgi')
-        sudo('pip install uwsgitop')
+        self._package_ensure('nginx')
+        self._pip_install('uwsgi')
+        self._pip_install('uwsgitop')
 
+    @stage
     def create_database_user(self):
         # Create a postgresql database user.
-        postgresql_role_ensure(self.database_user, self.database_password, createdb=True, superuser=True)
+        if self.backend:
+            self._remote(
+                'database', 'ensure role %s' % self.database_user, self._backend_run,
+                'psql -tAc %s | grep -q 1 || psql -c %s' % (
+                    shell_quote("SELECT 1 FROM pg_roles WHERE rolname=%s" %
+                                sql_literal(self.database_user)),
+                    shell_quote('CREATE ROLE %s WITH LOGIN PASSWORD %s CREATEDB SUPERUSER' % (
+                        sql_identifier(self.database_user), sql_literal(self.database_password)
+                    ))
+                ),
+                sudo=True, user='postgres'
+            )
+            return
+        self._remote(
+            'database', 'ensure role %s' % self.database_user, postgresql_role_ensure,
+            self.database_user, self.database_password, createdb=True, superuser=True
+        )
 
+    @stage
     def create_database(self):
         # Create a postgresql database.
-        postgresql_database_ensure(
-            self.database_name,
-            owner=self.database_user,
-            encoding='UTF8',
-            template='template0',
-            locale='en_US.UTF-8'
-        )
+        if self.backend:
+            self._remote(
+                'database', 'ensure database %s' % self.database_name, self._backend_run,
+                'psql -tAc %s | grep -q 1 || '
+                'createdb -O %s -E UTF8 -T template0 --locale=en_US.UTF-8 %s' % (
+                    shell_quote("SELECT 1 FROM pg_database WHERE datname=%s" %
+                                sql_literal(self.database_name)),
+                    shell_quote(self.database_user), shell_quote(self.database_name)
+                ),
+                sudo=True, user='postgres'
+            )
+        else:
+            self._remote(
+                'database', 'ensure database %s' % self.database_name, postgresql_database_ensure,
+                self.database_name,
+                owner=self.database_user,
+                encoding='UTF8',
+                template='template0',
+                locale='en_US.UTF-8'
+            )
 
         if self.deploy_postgis:
             self.setup_postgis_for_database()
 
+    @stage
     def setup_bitbucket_key(self):
         # Setup access to a bitbucket account.
         with mode_sudo():
-            dir_ensure('/root/.ssh/')
-        put('deploykey', '~/id_rsa')
-        put('deploykey.pub', '~/id_rsa.pub')
+            self._run('mkdir -p /root/.ssh/')
+        self._put('deploykey', '~/id_rsa')
+        self._put('deploykey.pub', '~/id_rsa.pub')
         bitbuckethost = 'bitbucket.org ssh-rsa AAAAB3NzaC1yc2EAAAABIwAAAQEAu' \
             'biN81eDcafrgMeLzaFPsw2kNvEcqTKl/VqLat/MaB33pZy0y3rJZtnqwR2qOOvb' \
             'wKZYKiEO1O6VqNEBxKvJJelCq0dTXWT5pbO2gDXC6h6QDXCaHo6pOHGPUy+YBaG' \
@@ -410,10 +1528,11 @@ class DjangoStack(TaskSet):
             '0sJ5N6m5E8VLjObPEO+mN2t/FZTMZLiFqPWc/ALSqnMnnhwrNi2rbfg/rd/IpL8' \
             'Le3pSBne8+seeFVBoGqzHM9yXw=='
         with mode_sudo():
-            run('mv ~/id_rsa /root/.ssh/')
-            run('mv ~/id_rsa.pub /root/.ssh/')
-            run("echo '%s' >> /root/.ssh/known_hosts" % bitbuckethost)
+            self._run('mv ~/id_rsa /root/.ssh/')
+            self._run('mv ~/id_rsa.pub /root/.ssh/')
+            self._run("echo '%s' >> /root/.ssh/known_hosts" % bitbuckethost)
 
+    @stage
     def checkout_code(self):
         # Checkout all code added to self.repositories.
         scm_command = scm_dir = scm_ignore = None
@@ -430,109 +1549,188 @@ class DjangoStack(TaskSet):
         # Primarily due to Microsoft Windows issues, we pull all repositories initially
         # to the /tmp/project_name directory, copy them to their expected directory and
         # finally delete the /tmp/project_name directory.
-        run('rm -fr /tmp/%s/' % self.project_name)
+        self._run('rm -fr /tmp/%s/' % self.project_name)
         for source_repository, destination, kwargs in self.repositories:
             with mode_sudo():
                 # First remove all trace of previous clones.
-                run('rm -fr %s*' % destination)
-                run('rm -fr %s%s' % (destination, scm_dir))
-                run('rm -fr %s%s' % (destination, scm_ignore))
+                self._run('rm -fr %s*' % destination)
+                self._run('rm -fr %s%s' % (destination, scm_dir))
+                self._run('rm -fr %s%s' % (destination, scm_ignore))
                 # Clone
-                run('%s %s %s' % (scm_command, source_repository, '/tmp/%s/' % self.project_name))
+                self._run('%s %s %s' % (scm_command, source_repository, '/tmp/%s/' % self.project_name))
                 # Ensure destination exists.
-                run('mkdir -p %s' % destination)
+                self._run('mkdir -p %s' % destination)
                 # Copy
-                run('cp -R /tmp/%s/* %s' % (self.project_name, destination))
-                run('cp -R /tmp/%s/%s %s' % (self.project_name, scm_dir, destination))
-                run('cp /tmp/%s/%s %s' % (self.project_name, scm_ignore, destination))
+                self._run('cp -R /tmp/%s/* %s' % (self.project_name, destination))
+                self._run('cp -R /tmp/%s/%s %s' % (self.project_name, scm_dir, destination))
+                self._run('cp /tmp/%s/%s %s' % (self.project_name, scm_ignore, destination))
                 # Delete /tmp/project_name
-                run('rm -fr /tmp/%s/' % self.project_name)
+                self._run('rm -fr /tmp/%s/' % self.project_name)
 
         # Execute all external post checkout functions.
         for hook in self.post_checkout_hooks:
-            hook()
+            self._remote('hook', getattr(hook, '__name__', repr(hook)), hook)
 
+    @stage
     def install_django_project_requirements(self):
         # Install all Django project requirements.
         if self.django_project_requirements_path:
             if not self.deploy_database:
                 # Ensures dependencies are installed if deploy_database is False
                 # and psycopg2 exists in the requirements file.
-                if contains(self.django_project_requirements_path, 'psycopg2', use_sudo=True):
-                    package_ensure('python-psycopg2')
-            sudo('pip install -r %s' % self.django_project_requirements_path)
+                with mode_sudo():
+                    has_psycopg2 = self._contains(self.django_project_requirements_path, 'psycopg2')
+                if has_psycopg2:
+                    self._package_ensure('python-psycopg2')
+            self._pip_install('-r %s' % self.django_project_requirements_path)
+
+    def _requirements_hash(self):
+        # Hash of the python dependencies merged with the Django project's
+        # requirements file, identifying the virtualenv they are installed in.
+        requirements = sorted(self.python_dependencies)
+        if self.deploy_django and self.django_project_requirements_path:
+            with mode_sudo():
+                requirements.append(self._query('cat %s' % self.django_project_requirements_path))
+        return hashlib.sha1('\n'.join(requirements).encode('utf-8')).hexdigest()[:12]
+
+    @stage
+    def setup_virtualenv(self):
+        # Activate the virtualenv for the current requirements, building it next to
+        # the existing ones first if it does not exist yet. The new virtualenv is
+        # unpacked from prebuilt_virtualenv_name when given, and the active one is
+        # switched by atomically replacing the <virtualenv_root>current symlink.
+        # A virtualenv is only complete once its .complete marker has been written
+        # after every install, so one left behind by a failed build is rebuilt.
+        virtualenv_path = '%s%s' % (self.virtualenv_root, self._requirements_hash())
+        pip = '%s/bin/pip' % virtualenv_path
+        with mode_sudo():
+            if not self._exists('%s/.complete' % virtualenv_path):
+                self._run('rm -fr %s' % virtualenv_path)
+                if self.prebuilt_virtualenv_name:
+                    self._put(self.prebuilt_virtualenv_name, '/tmp/djangostack_virtualenv.tar.gz',
+                              use_sudo=True)
+                    self._run('mkdir -p %s' % virtualenv_path)
+                    self._run('tar xzf /tmp/djangostack_virtualenv.tar.gz -C %s' % virtualenv_path)
+                    self._run('rm -f /tmp/djangostack_virtualenv.tar.gz')
+                else:
+                    self._run('virtualenv %s' % virtualenv_path)
+
+                for dependency in self.python_dependencies:
+                    self._pip_install(dependency, pip=pip)
+                if self.deploy_django and self.django_project_requirements_path:
+                    if not self.deploy_database and self._contains(
+                            self.django_project_requirements_path, 'psycopg2'):
+                        # psycopg2 is built in the virtualenv rather than installed
+                        # system wide.
+                        self._package_ensure('libpq-dev')
+                    self._pip_install('-r %s' % self.django_project_requirements_path, pip=pip)
+                self._run('touch %s/.complete' % virtualenv_path)
+
+            self.deploy_state['virtualenv'] = virtualenv_path
+            self._run('touch %s' % virtualenv_path)
+            self._run('ln -sfn %s %scurrent.new' % (virtualenv_path, self.virtualenv_root))
+            self._run('mv -T %scurrent.new %scurrent' % (self.virtualenv_root, self.virtualenv_root))
+            # Remove all but the virtualenv_keep most recently activated virtualenvs.
+            self._run(
+                'cd %s && ls -1t | grep -v current | tail -n +%s | xargs -r rm -fr' %
+                (self.virtualenv_root, self.virtualenv_keep + 1)
+            )
 
+            if self.deploy_web_server and self.web_server == 'apache':
+                self._run(
+                    "echo 'WSGIPythonHome %scurrent' > /etc/apache2/conf-available/%s-wsgi.conf" %
+                    (self.virtualenv_root, self.project_name)
+                )
+                self._run('a2enconf %s-wsgi' % self.project_name)
+
+    @stage
     def setup_web_server(self):
         # Setup web server. Note the actually server software has already
         # been installed by this stage, this is more of a configuration step.
         if self.web_server == 'apache':
             with mode_sudo():
-                run('rm -f /etc/apache2/sites-enabled/000-default')
-                run('rm -f /etc/apache2/sites-enabled/%s' % self.project_name)
-                run('rm -f /etc/apache2/sites-available/%s' % self.project_name)
+                self._run('rm -f /etc/apache2/sites-enabled/000-default')
+                self._run('rm -f /etc/apache2/sites-enabled/%s' % self.project_name)
+                self._run('rm -f /etc/apache2/sites-available/%s' % self.project_name)
 
-                put(
+                self._put(
                     '%s' % self.web_server_config_name,
                     '/etc/apache2/sites-available/%s' % self.project_name, use_sudo=True
                 )
-                run(
+                self._run(
                     'ln -s /etc/apache2/sites-available/%s /etc/apache2/sites-enabled/%s' %
                     (self.project_name, self.project_name)
                 )
         elif self.web_server == 'nginx':
             with mode_sudo():
-                run('rm -f /etc/nginx/sites-enabled/default')
-                run('rm -f /etc/nginx/sites-enabled/%s' % self.project_name)
-                run('rm -f /etc/nginx/sites-available/%s' % self.project_name)
-
-                put(
-                    '%s' % self.web_server_config_name,
-                    '/etc/nginx/sites-available/%s' % self.project_name, use_sudo=True
-                )
-                run(
+                self._run('rm -f /etc/nginx/sites-enabled/default')
+                self._run('rm -f /etc/nginx/sites-enabled/%s' % self.project_name)
+                self._run('rm -f /etc/nginx/sites-available/%s' % self.project_name)
+
+                if self.web_server_config_name:
+                    self._put(
+                        '%s' % self.web_server_config_name,
+                        '/etc/nginx/sites-available/%s' % self.project_name, use_sudo=True
+                    )
+                else:
+                    self._tune_nginx()
+                    if self.nginx_micro_cache_seconds:
+                        self._run(
+                            'mkdir -p /var/cache/nginx/%s' % re.sub(r'\W', '_', self.project_name)
+                        )
+                    self._put(
+                        StringIO(self._nginx_site_config()),
+                        '/etc/nginx/sites-available/%s' % self.project_name,
+                        description='generated nginx site -> /etc/nginx/sites-available/%s' %
+                        self.project_name, use_sudo=True
+                    )
+                self._run(
                     'ln -s /etc/nginx/sites-available/%s /etc/nginx/sites-enabled/%s' %
                     (self.project_name, self.project_name)
                 )
 
                 if self.uwsgi_ini_name:
-                    put('%s' % self.uwsgi_ini_name, '%s' % self.uwsgi_ini_path, use_sudo=True)
+                    self._put('%s' % self.uwsgi_ini_name, '%s' % self.uwsgi_ini_path, use_sudo=True)
                 if self.uwsgi_params_name:
-                    put(
+                    self._put(
                         '%s' % self.uwsgi_params_name, '%s' % self.uwsgi_params_path, use_sudo=True
                     )
 
+    @stage
     def restore_database_configuration(self):
         # Restore a postgresql database pg_hba.conf and postgresql.conf configuration.
         with mode_sudo():
             if self.pg_hba_conf_name:
-                file_path = run("find /etc/postgresql -name 'pg_hba.conf'")
+                file_path = self._query("find /etc/postgresql -name 'pg_hba.conf'")
                 if file_path:
-                    put(self.pg_hba_conf_name, file_path, use_sudo=True)
-                    run('chown postgres:postgres %s' % file_path)
+                    self._put(self.pg_hba_conf_name, file_path, use_sudo=True)
+                    self._run('chown postgres:postgres %s' % file_path)
             if self.postgresql_conf_name:
-                file_path = run("find /etc/postgresql -name 'postgresql.conf'")
+                file_path = self._query("find /etc/postgresql -name 'postgresql.conf'")
                 if file_path:
-                    put(self.postgresql_conf_name, file_path, use_sudo=True)
-                    run('chown postgres:postgres %s' % file_path)
+                    self._put(self.postgresql_conf_name, file_path, use_sudo=True)
+                    self._run('chown postgres:postgres %s' % file_path)
 
+    @stage
     def restore_database_dump(self):
         # Restore a postgresql database dump.
         with mode_sudo():
-            if not exists('/var/lib/postgresql/%s' % self.database_dump_name):
-                put(self.database_dump_name, '/var/lib/postgresql/', use_sudo=True)
-            run('chown postgres /var/lib/postgresql/%s' % self.database_dump_name)
+            if not self._exists('/var/lib/postgresql/%s' % self.database_dump_name):
+                self._put(self.database_dump_name, '/var/lib/postgresql/', use_sudo=True)
+            self._run('chown postgres /var/lib/postgresql/%s' % self.database_dump_name)
 
             if self.deploy_postgis:
                 if self.database_dump_type == 'SQL':
-                    run(
+                    self._run(
                         'cd /var/lib/postgresql;'
-                        'psql %s < %s' % (self.database_name, self.database_dump_name), user='postgres'
+                        'psql %s < %s' % (self.database_name, self.database_dump_name),
+                        kind='database', user='postgres'
                     )
                 else:
-                    run(
+                    self._run(
                         'cd /var/lib/postgresql;'
                         'pg_restore -d %s %s' % (self.database_name, self.database_dump_name),
-                        user='postgres'
+                        kind='database', user='postgres'
                     )
             else:
                 action_string = "cd /var/lib/postgresql;" \
@@ -540,38 +1738,76 @@ class DjangoStack(TaskSet):
                         "{0} | psql -h localhost -U postgres {1} 2> errors.txt".format(self.database_dump_name,
                                                                                        self.database_name)
 
-                sudo(action_string, user='postgres')
+                self._sudo(action_string, kind='database', user='postgres')
 
+    @stage
     def migrate(self):
-        # Django migrate.
+        # Django migrate. While planning, the pending migrations of the currently
+        # deployed code are listed individually.
         if self.django_project_path and self.run_migrations:
-            sudo(
-                'cd %s;python manage.py migrate --noinput;' % self.django_project_path
+            if self.plan is not None:
+                pending = self._query(
+                    'cd %s;%s manage.py showmigrations --plan' %
+                    (self.django_project_path, self._python_bin())
+                )
+                for line in pending.splitlines():
+                    if line.strip().startswith('[ ]'):
+                        self.plan.add(self._current_stage, 'migration', line.strip()[3:].strip())
+            self._sudo(
+                'cd %s;%s manage.py migrate --noinput;' %
+                (self.django_project_path, self._python_bin()),
+                kind='migration'
             )
 
+    @stage
     def collect_static(self):
-        # Django collectstatic.
+        # Django collectstatic. Text assets are also precompressed for nginx's
+        # gzip_static when the nginx site configuration is generated.
         if self.django_project_path:
             with mode_sudo():
                 if self.django_static_path:
-                    run('mkdir -p %s' % self.django_static_path)
-                run('cd %s;python manage.py collectstatic --noinput' % self.django_project_path)
+                    self._run('mkdir -p %s' % self.django_static_path)
+                self._run(
+                    'cd %s;%s manage.py collectstatic --noinput' %
+                    (self.django_project_path, self._python_bin())
+                )
+                if self.django_static_path and self.deploy_web_server and \
+                        self.web_server == 'nginx' and not self.web_server_config_name:
+                    self._run(
+                        "find %s -type f \\( -name '*.css' -o -name '*.js' -o -name '*.svg' "
+                        "-o -name '*.json' -o -name '*.txt' \\) "
+                        "-exec sh -c 'gzip -9 -c \"$0\" > \"$0.gz\"' {} \\;" % self.django_static_path
+                    )
 
+    @stage
     def move_local_settings_file(self):
-        # Move a Django local_settings.py file into place.
+        # Move a Django local_settings.py file into place. If deploy_cache is True the
+        # cache settings are appended to it.
         if self.django_local_settings_name and self.django_local_settings_path:
-            put(
+            self._put(
                 self.django_local_settings_name, self.django_local_settings_path,
                 use_sudo=True
             )
+            if self.deploy_cache:
+                settings_path = self.django_local_settings_path
+                if settings_path.endswith('/'):
+                    settings_path += os.path.basename(self.django_local_settings_name)
+                with mode_sudo():
+                    self._append(settings_path, self._cache_settings())
+        elif self.deploy_cache:
+            warn(
+                'django_local_settings_name and django_local_settings_path are not set. '
+                'Could not write the cache settings.'
+            )
 
+    @stage
     def make_and_compile_messages(self, use_transifex=False):
         # Django makemessages and compilemessages. This function will also attempt to
         # pull po files from transifex if the correct arguments are specified.
         if use_transifex and self.django_locale_path:
-            put(self.transifexrc_name, '~/', use_sudo=True)
-            if dir_exists('%s.tx' % self.django_locale_path):
-                sudo('cd %s;tx pull -f' % self.django_locale_path)
+            self._put(self.transifexrc_name, '~/', use_sudo=True)
+            if self._dir_exists('%s.tx' % self.django_locale_path):
+                self._sudo('cd %s;%s pull -f' % (self.django_locale_path, self._python_bin('tx')))
             else:
                 warn(
                     'Could not find .tx directory in the locale directory. '
@@ -579,32 +1815,241 @@ class DjangoStack(TaskSet):
                 )
         if self.django_project_path:
             with mode_sudo():
-                run(
-                    'cd %s;python manage.py makemessages -a %s' %
-                    (self.django_project_path, self.make_messages_args)
+                self._run(
+                    'cd %s;%s manage.py makemessages -a %s' %
+                    (self.django_project_path, self._python_bin(), self.make_messages_args)
                 )
-                run(
-                    'cd %s;python manage.py makemessages -a -d djangojs %s' %
-                    (self.django_project_path, self.make_messages_args)
+                self._run(
+                    'cd %s;%s manage.py makemessages -a -d djangojs %s' %
+                    (self.django_project_path, self._python_bin(), self.make_messages_args)
+                )
+                self._run(
+                    'cd %s;%s manage.py compilemessages' %
+                    (self.django_project_path, self._python_bin())
                 )
-                run('cd %s;python manage.py compilemessages' % self.django_project_path)
 
+    @stage
     def run_post_build_hooks(self):
         # Execute all external post build functions.
         for hook in self.post_build_hooks:
-            hook()
+            self._remote('hook', getattr(hook, '__name__', repr(hook)), hook)
 
+    @stage
+    def update_repository_permissions(self):
+        # Apply the permissions requested for each checkout.
+        self._update_repository_permissions()
+
+    @stage
     def restart_services(self):
         # Restart the relevant services.
         with mode_sudo():
             if self.deploy_web_server:
                 if self.web_server == 'apache':
-                    run('service apache2 restart', pty=False)
+                    self._run('service apache2 restart', kind='service', pty=False)
                 elif self.web_server == 'nginx':
-                    run('service nginx restart')
-                    run('uwsgi --ini %s' % self.uwsgi_ini_path)
+                    self._run('service nginx restart', kind='service')
+                    if self.use_virtualenv:
+                        self._run(
+                            'uwsgi --ini %s --virtualenv %scurrent' %
+                            (self.uwsgi_ini_path, self.virtualenv_root), kind='service'
+                        )
+                    else:
+                        self._run('uwsgi --ini %s' % self.uwsgi_ini_path, kind='service')
             if self.deploy_database:
-                run('service postgresql restart')
+                self._run('service postgresql restart', kind='service')
+            if self.deploy_cache and self._cache_config_changed:
+                self._restart_cache()
+
+    def _web_worker_count(self):
+        # The number of requests the application server handles at once: uWSGI's
+        # processes times threads from uwsgi_ini_path, or those of the mod_wsgi
+        # daemon in the apache site configuration. None if they cannot be read.
+        with mode_sudo():
+            if self.web_server == 'nginx':
+                config = self._query('cat %s' % self.uwsgi_ini_path)
+                processes = re.search(r'^\s*(?:processes|workers)\s*=\s*(\d+)', config, re.M)
+                threads = re.search(r'^\s*threads\s*=\s*(\d+)', config, re.M)
+                default_threads = 1
+            else:
+                config = self._query('cat /etc/apache2/sites-available/%s' % self.project_name)
+                daemon = re.search(r'^\s*WSGIDaemonProcess\b.*$', config, re.M)
+                if not daemon:
+                    return None
+                processes = re.search(r'\bprocesses=(\d+)', daemon.group(0))
+                threads = re.search(r'\bthreads=(\d+)', daemon.group(0))
+                # mod_wsgi's daemon defaults to 1 process of 15 threads.
+                if not processes:
+                    return int(threads.group(1)) if threads else 15
+                default_threads = 15
+        if not processes:
+            return None
+        return int(processes.group(1)) * (int(threads.group(1)) if threads else default_threads)
+
+    @stage
+    def warm_up(self):
+        # Warm up the restarted workers by requesting warmup_urls concurrently until
+        # their latency settles, then load test the site for load_test_seconds and
+        # compare the results with the previous release's, saved in the deploy state.
+        # Unless warmup_concurrency is given, as many requests are made at once as
+        # the application server has workers, so that each of them is warmed.
+        # Requests carry the site's Host header (see _site_host).
+        script_path = '/tmp/djangostack_loadtest.py'
+        self._put(os.path.join(os.path.dirname(__file__), 'loadtest.py'), script_path)
+        concurrency = self.warmup_concurrency or self._web_worker_count() or \
+            self._host_cpu_count() * 2
+        host_option = ''
+        if self._site_host():
+            host_option = '--host %s ' % shell_quote(self._site_host())
+        output = self._run(
+            '$(command -v python3 || command -v python) %s --base-url %s %s--concurrency %s '
+            '--duration %s --max-rounds %s %s' % (
+                script_path, shell_quote(self.warmup_base_url), host_option, concurrency,
+                self.load_test_seconds, self.warmup_max_rounds,
+                ' '.join(shell_quote(url) for url in self.warmup_urls)
+            )
+        )
+        if self.plan is not None:
+            return
+
+        results = json.loads(output.splitlines()[-1])
+        previous = self.deploy_state.get('load_test')
+        self.deploy_state['load_test'] = results
+        if not self.load_test_seconds:
+            return
+        print(
+            'Load test: %(requests_per_second)s requests/sec, p50 %(p50)ss, p99 %(p99)ss, '
+            '%(errors)s errors' % results
+        )
+        if results['errors']:
+            self._load_test_failed('%s of %s load test requests failed.' % (
+                results['errors'], results['requests']
+            ))
+        elif previous and previous.get('p99') and \
+                results['p99'] > previous['p99'] * (1 + self.load_test_max_regression):
+            self._load_test_failed(
+                'p99 latency regressed from %ss to %ss.' % (previous['p99'], results['p99'])
+            )
+
+    def _load_test_failed(self, message):
+        # Act on a failed load test according to load_test_failure_action.
+        if self.load_test_failure_action == 'warn':
+            warn(message)
+            return
+        if self.load_test_failure_action == 'rollback':
+            for hook in self.rollback_hooks:
+                hook()
+        abort('%s DjangoStack deployment aborted.' % message)
+
+
+class TelemetryMonitor(threading.Thread):
+    """
+    Prints a progress line with the host's latest telemetry sample every
+    interval seconds while a stage is running, so a slow stage can be told
+    apart from a hung one.
+
+    """
+    def __init__(self, host_string, latest_sample, interval):
+        super(TelemetryMonitor, self).__init__()
+        self.daemon = True
+        self.host_string = host_string
+        self.latest_sample = latest_sample
+        self.interval = interval
+        self.stage = None
+        self.stage_start = None
+        self._stopped = threading.Event()
+
+    def stage_started(self, stage, start):
+        # Set the running stage (None between stages).
+        self.stage, self.stage_start = stage, start
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            stage, stage_start = self.stage, self.stage_start
+            if stage is None:
+                continue
+            line = '[%s] %s running for %ds' % (self.host_string, stage, time.time() - stage_start)
+            try:
+                sample = self.latest_sample(self.host_string)
+            except Exception:
+                sample = None
+            if sample:
+                line += ': %s' % describe(sample)
+            print(line)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class DeployPlan(object):
+    """
+    The ordered remote operations a DjangoStack deployment would perform, as
+    recorded by DjangoStack.plan_stack, with costs estimated from the timings
+    saved by the previous deployment.
+
+    """
+    def __init__(self, operation_timings=None, stage_timings=None, stage_operations=None):
+        self.operations = []
+        self.operation_timings = operation_timings or {}
+        self.stage_timings = stage_timings or {}
+        self.stage_operations = stage_operations or {}
+
+    def add(self, stage, kind, description):
+        # Record an operation. Its cost is the time the same operation took last run,
+        # or None if it has not been run before.
+        self.operations.append({
+            'stage': stage,
+            'kind': kind,
+            'description': description,
+            'cost': self.operation_timings.get(operation_key(kind, description)),
+        })
+
+    def stages(self):
+        # Return the planned stages in order, each with its operations.
+        stages = []
+        for operation in self.operations:
+            if not stages or stages[-1][0] != operation['stage']:
+                stages.append((operation['stage'], []))
+            stages[-1][1].append(operation)
+        return stages
+
+    def stage_cost(self, stage, operations):
+        # Return (seconds, unknown): the estimated time of a planned stage and how
+        # many of its operations have no recorded cost. The stage's measured time is
+        # used if the last run timed exactly these operations in it, as it also
+        # covers the read-only checks made between them. Otherwise the recorded
+        # costs of the planned operations are summed.
+        keys = [operation_key(operation['kind'], operation['description'])
+                for operation in operations]
+        if stage in self.stage_timings and self.stage_operations.get(stage) == keys:
+            return self.stage_timings[stage], 0
+        costs = [operation['cost'] for operation in operations if operation['cost'] is not None]
+        return sum(costs), len(operations) - len(costs)
+
+    def total_cost(self):
+        # Return (seconds, unknown) summed over the planned stages.
+        costs = [self.stage_cost(stage, operations) for stage, operations in self.stages()]
+        return sum(cost[0] for cost in costs), sum(cost[1] for cost in costs)
+
+    def render(self, host=None):
+        # Return the plan as printable lines. Operations of unknown cost are counted
+        # next to each estimate rather than taken as free.
+        def estimate(seconds, unknown):
+            if unknown:
+                return '%.1fs + %d operation%s of unknown cost' % (
+                    seconds, unknown, '' if unknown == 1 else 's'
+                )
+            return '%.1fs' % seconds
+
+        lines = ['Deployment plan%s: %d operations, estimated %s' % (
+            ' for %s' % host if host else '', len(self.operations), estimate(*self.total_cost())
+        )]
+        for stage, operations in self.stages():
+            lines.append('  %s (~%s)' % (stage, estimate(*self.stage_cost(stage, operations))))
+            for operation in operations:
+                cost = '?' if operation['cost'] is None else '%.1fs' % operation['cost']
+                lines.append('    %-10s %-60s %s' % (operation['kind'], operation['description'], cost))
+        return lines
 
 
 class InvalidArgumentException(Exception):
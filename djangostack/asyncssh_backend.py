@@ -0,0 +1,214 @@
+"""
+An asyncio execution backend for DjangoStack, selected with
+execution_backend='asyncssh'. Every host gets one SSH connection, opened on
+first use and kept for the whole deployment, over which each command runs on
+its own channel. The event loop runs on a background thread so DjangoStack's
+blocking stage methods can use it unchanged.
+
+Stage methods still deploy one host per process: Fabric's env and cuisine's
+modes are process-global, so setup_stack and every host of a rolling_deploy
+batch get their own process, event loop and connection. Only run_many, behind
+DjangoStack.run_on_hosts, drives many hosts from one process.
+
+Requires Python 3, asyncssh and a Python 3 port of Fabric 1 (Fabric3).
+
+"""
+import asyncio
+import os
+import shlex
+import threading
+
+import asyncssh
+from fabric.api import abort, env
+from fabric.state import output
+
+# sudo's password prompt, and the line printed once sudo has started the command.
+SUDO_PROMPT = 'djangostack sudo password: '
+SUDO_STARTED = 'djangostack sudo started'
+
+
+class CommandResult(str):
+    """
+    Output of a remote command, with the same attributes as the strings returned
+    by Fabric's run and sudo.
+
+    """
+    def __new__(cls, stdout, return_code, command):
+        result = super(CommandResult, cls).__new__(cls, stdout)
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        result.command = command
+        return result
+
+
+class AsyncSSHBackend(object):
+    """
+    Runs commands and uploads files over one multiplexed asyncssh connection per
+    host. At most max_concurrency commands run at once across all hosts.
+
+    """
+    def __init__(self, max_concurrency=100):
+        self.max_concurrency = max_concurrency
+        self._pid = None
+
+    def _ensure_loop(self):
+        # Start the event loop thread, again in a process forked by Fabric's
+        # parallel execution, which does not inherit the parent's thread.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._connections = {}
+            self._loop = asyncio.new_event_loop()
+            self._semaphore = None
+            thread = threading.Thread(target=self._loop.run_forever)
+            thread.daemon = True
+            thread.start()
+        return self._loop
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._ensure_loop()).result()
+
+    def _connection(self, host_string):
+        # Return the task opening host_string's connection, shared by every caller.
+        if host_string not in self._connections:
+            user, _, host = host_string.rpartition('@')
+            host, _, port = host.partition(':')
+            key_filename = env.key_filename
+            if isinstance(key_filename, str):
+                key_filename = [key_filename]
+            self._connections[host_string] = asyncio.ensure_future(asyncssh.connect(
+                host, port=int(port or env.port or 22), username=user or env.user,
+                password=env.password, client_keys=key_filename or (),
+                known_hosts=None if env.disable_known_hosts else (),
+            ))
+        return self._connections[host_string]
+
+    def _command(self, command, sudo=False, user=None):
+        # Wrap command the way Fabric does: in a login shell, optionally under sudo.
+        # Under sudo the command prints SUDO_STARTED first, so _run can tell sudo's
+        # password prompt apart from the command reading its stdin.
+        command = 'bash -l -c %s' % shlex.quote(command)
+        if sudo:
+            command = 'sudo -S -p %s -H %sbash -c %s' % (
+                shlex.quote(SUDO_PROMPT), '-u %s ' % user if user else '',
+                shlex.quote('echo %s; exec %s' % (SUDO_STARTED, command))
+            )
+        return command
+
+    async def _run(self, host_string, command, sudo=False, user=None, quiet=False):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            connection = await self._connection(host_string)
+            process = await connection.create_process(
+                self._command(command, sudo, user), stderr=asyncssh.STDOUT
+            )
+            # Under sudo, answer its password prompt the first time it appears, then
+            # close stdin once the command has started (or the password was refused).
+            password = env.sudo_password or env.password
+            waiting_for_sudo = sudo
+            if not waiting_for_sudo:
+                process.stdin.write_eof()
+            lines = []
+            pending = ''
+            while True:
+                chunk = await process.stdout.read(4096)
+                pending += chunk
+                if waiting_for_sudo and SUDO_PROMPT in pending:
+                    pending = pending.replace(SUDO_PROMPT, '', 1)
+                    if password:
+                        process.stdin.write(password + '\n')
+                        password = None
+                    else:
+                        process.stdin.write_eof()
+                        waiting_for_sudo = False
+                if waiting_for_sudo and SUDO_STARTED + '\n' in pending:
+                    pending = ''.join(pending.partition(SUDO_STARTED + '\n')[::2])
+                    process.stdin.write_eof()
+                    waiting_for_sudo = False
+                if not chunk:
+                    pending += '\n' if pending else ''
+                while '\n' in pending:
+                    line, pending = pending.split('\n', 1)
+                    line = line.rstrip('\r')
+                    lines.append(line)
+                    if not quiet and output.stdout:
+                        print('[%s] out: %s' % (host_string, line))
+                if not chunk:
+                    break
+            completed = await process.wait()
+        return CommandResult('\n'.join(lines), completed.exit_status, command)
+
+    def run(self, command, sudo=False, user=None, warn_only=False, quiet=False,
+            host_string=None):
+        # Run command on host_string (the current Fabric host by default), streaming
+        # its output. Aborts if it fails, unless warn_only is True.
+        host_string = host_string or env.host_string
+        if not quiet and output.running:
+            print('[%s] %s: %s' % (host_string, 'sudo' if sudo else 'run', command))
+        result = self._call(self._run(host_string, command, sudo, user, quiet))
+        if result.failed and not warn_only:
+            abort('%s returned %s on %s: %s' % (
+                'sudo' if sudo else 'run', result.return_code, host_string, command
+            ))
+        return result
+
+    def run_many(self, hosts, command, sudo=False, user=None):
+        # Run command on every host concurrently and return {host: CommandResult}.
+        async def run_all():
+            results = await asyncio.gather(*[
+                self._run(host, command, sudo, user, quiet=True) for host in hosts
+            ])
+            return dict(zip(hosts, results))
+        return self._call(run_all())
+
+    async def _put(self, host_string, local_path, remote_path, use_sudo):
+        connection = await self._connection(host_string)
+        # SFTP paths are relative to the home directory.
+        if remote_path in ('~', '~/'):
+            remote_path = ''
+        elif remote_path.startswith('~/'):
+            remote_path = remote_path[2:]
+        if not hasattr(local_path, 'read') and (remote_path.endswith('/') or not remote_path):
+            remote_path += os.path.basename(local_path)
+        upload_path = remote_path
+        if use_sudo:
+            # A fresh file only the login user can read, since uploads include
+            # settings with secrets; it is moved into place with sudo by put.
+            created = await self._run(host_string, 'mktemp', quiet=True)
+            if created.failed:
+                abort('Could not create a temporary file on %s: %s' % (host_string, created))
+            upload_path = created.strip()
+        async with connection.start_sftp_client() as sftp:
+            if hasattr(local_path, 'read'):
+                async with sftp.open(upload_path, 'w') as remote_file:
+                    await remote_file.write(local_path.read())
+            else:
+                await sftp.put(local_path, upload_path)
+        return upload_path, remote_path
+
+    def put(self, local_path, remote_path, use_sudo=False, host_string=None):
+        # Upload a local file or file-like object, moving it into place with sudo
+        # if use_sudo is True.
+        host_string = host_string or env.host_string
+        upload_path, remote_path = self._call(
+            self._put(host_string, local_path, remote_path, use_sudo)
+        )
+        if use_sudo:
+            self.run('mv %s %s' % (upload_path, remote_path), sudo=True,
+                     host_string=host_string)
+        return remote_path
+
+    async def _close(self):
+        for connecting in self._connections.values():
+            if connecting.done() and not connecting.cancelled() and not connecting.exception():
+                connection = connecting.result()
+                connection.close()
+                await connection.wait_closed()
+
+    def close(self):
+        # Close every connection opened by this process.
+        if self._pid != os.getpid():
+            return
+        self._call(self._close())
+        self._connections = {}
@@ -0,0 +1,131 @@
+"""
+Warm up and load test a freshly restarted Django site. This script is copied
+to the deployed server and run there by DjangoStack.warm_up, so it only uses
+the standard library and runs under both Python 2 and 3. The results are
+printed as a single line of JSON.
+
+"""
+import json
+import math
+import optparse
+import threading
+import time
+
+try:
+    from urllib2 import urlopen, HTTPError, Request
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+
+
+def fetch(url, timeout, host=None):
+    # Request url, with host as its Host header if given, and return (latency in
+    # seconds, whether it succeeded).
+    request = Request(url, headers={'Host': host} if host else {})
+    start = time.time()
+    try:
+        response = urlopen(request, timeout=timeout)
+        response.read()
+        ok = response.getcode() < 400
+    except HTTPError as e:
+        ok = e.code < 400
+    except Exception:
+        ok = False
+    return time.time() - start, ok
+
+
+def percentile(values, percent):
+    # Nearest-rank percentile of values.
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def run_concurrently(concurrency, target):
+    threads = [threading.Thread(target=target) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def warm_up(urls, concurrency, max_rounds, tolerance, timeout, host=None):
+    # Request every url concurrency times at once, so that each worker is hit,
+    # until the median latency of a round is within tolerance of the previous one.
+    previous = None
+    for round_number in range(1, max_rounds + 1):
+        latencies = []
+        lock = threading.Lock()
+
+        def worker():
+            for url in urls:
+                latency, ok = fetch(url, timeout, host)
+                with lock:
+                    latencies.append(latency)
+
+        run_concurrently(concurrency, worker)
+        median = percentile(latencies, 50)
+        if previous is not None and abs(median - previous) <= previous * tolerance:
+            return round_number
+        previous = median
+    return max_rounds
+
+
+def load_test(urls, concurrency, duration, timeout, host=None):
+    # Request urls in a loop from concurrency threads for duration seconds.
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def worker():
+        index = 0
+        while time.time() < deadline:
+            latency, ok = fetch(urls[index % len(urls)], timeout, host)
+            index += 1
+            with lock:
+                latencies.append(latency)
+                if not ok:
+                    errors[0] += 1
+
+    start = time.time()
+    run_concurrently(concurrency, worker)
+    elapsed = time.time() - start
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'requests_per_second': round(len(latencies) / elapsed, 2),
+        'p50': round(percentile(latencies, 50) or 0, 4),
+        'p99': round(percentile(latencies, 99) or 0, 4),
+    }
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] url [url ...]')
+    parser.add_option('--base-url', default='http://127.0.0.1')
+    parser.add_option('--host', default=None)
+    parser.add_option('--concurrency', type='int', default=4)
+    parser.add_option('--duration', type='float', default=10)
+    parser.add_option('--max-rounds', type='int', default=10)
+    parser.add_option('--tolerance', type='float', default=0.1)
+    parser.add_option('--timeout', type='float', default=30)
+    options, paths = parser.parse_args()
+    urls = [options.base_url.rstrip('/') + '/' + path.lstrip('/') for path in paths or ['/']]
+
+    results = {
+        'warmup_rounds': warm_up(
+            urls, options.concurrency, options.max_rounds, options.tolerance, options.timeout,
+            options.host
+        )
+    }
+    if options.duration > 0:
+        results.update(load_test(
+            urls, options.concurrency, options.duration, options.timeout, options.host
+        ))
+    print(json.dumps(results, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
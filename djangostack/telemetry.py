@@ -0,0 +1,132 @@
+"""
+Resource telemetry for DjangoStack deployments. Run as a script, this samples
+the host's CPU, memory, disk I/O and network from /proc every interval seconds
+and appends each sample to a file as a line of JSON. It is copied to the
+deployed server and started in the background by DjangoStack when telemetry
+is True, so it only uses the standard library and runs under both Python 2
+and 3. summarise is used locally to reduce the samples taken during a stage.
+
+"""
+import json
+import optparse
+import re
+import time
+
+DISK_PATTERN = re.compile(r'^(sd[a-z]+|hd[a-z]+|vd[a-z]+|xvd[a-z]+|nvme\d+n\d+)$')
+
+
+def read_counters():
+    # Return the cumulative CPU, disk and network counters and the memory in use.
+    with open('/proc/stat') as stat:
+        cpu = [int(value) for value in stat.readline().split()[1:]]
+    memory = {}
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            key, value = line.split(':', 1)
+            memory[key] = int(value.split()[0])
+    available = memory.get(
+        'MemAvailable', memory['MemFree'] + memory.get('Buffers', 0) + memory.get('Cached', 0)
+    )
+    disk_read = disk_written = 0
+    with open('/proc/diskstats') as diskstats:
+        for line in diskstats:
+            fields = line.split()
+            if DISK_PATTERN.match(fields[2]):
+                disk_read += int(fields[5]) * 512
+                disk_written += int(fields[9]) * 512
+    net_received = net_sent = 0
+    with open('/proc/net/dev') as net:
+        for line in net.readlines()[2:]:
+            interface, fields = line.split(':', 1)
+            if interface.strip() != 'lo':
+                fields = fields.split()
+                net_received += int(fields[0])
+                net_sent += int(fields[8])
+    return {
+        'cpu_total': sum(cpu),
+        'cpu_idle': cpu[3],
+        'cpu_iowait': cpu[4] if len(cpu) > 4 else 0,
+        'memory_used_mb': (memory['MemTotal'] - available) // 1024,
+        'disk_read': disk_read,
+        'disk_written': disk_written,
+        'net_received': net_received,
+        'net_sent': net_sent,
+    }
+
+
+def sample(previous, current, seconds):
+    # Reduce two sets of counters taken seconds apart to a sample.
+    total = float(current['cpu_total'] - previous['cpu_total']) or 1.0
+    idle = current['cpu_idle'] - previous['cpu_idle']
+    iowait = current['cpu_iowait'] - previous['cpu_iowait']
+
+    def rate(key):
+        return round((current[key] - previous[key]) / seconds / 1048576.0, 3)
+
+    return {
+        'cpu': round(100 * (total - idle - iowait) / total, 1),
+        'iowait': round(100 * iowait / total, 1),
+        'memory_used_mb': current['memory_used_mb'],
+        'disk_read_mb_s': rate('disk_read'),
+        'disk_write_mb_s': rate('disk_written'),
+        'net_rx_mb_s': rate('net_received'),
+        'net_tx_mb_s': rate('net_sent'),
+    }
+
+
+def summarise(samples):
+    # Average the samples taken during a stage and name the resource it was
+    # bound by: cpu, disk (I/O wait), network or, if none was busy, wait
+    # (sleeping, locks or slow remote services).
+    if not samples:
+        return None
+    count = float(len(samples))
+    summary = dict(
+        (key, round(sum(sample[key] for sample in samples) / count, 3))
+        for key in ('cpu', 'iowait', 'disk_read_mb_s', 'disk_write_mb_s',
+                    'net_rx_mb_s', 'net_tx_mb_s')
+    )
+    summary['memory_peak_mb'] = max(sample['memory_used_mb'] for sample in samples)
+    summary['samples'] = len(samples)
+    if summary['cpu'] >= 75:
+        summary['bound'] = 'cpu'
+    elif summary['iowait'] >= 20:
+        summary['bound'] = 'disk'
+    elif summary['net_rx_mb_s'] + summary['net_tx_mb_s'] >= 1:
+        summary['bound'] = 'network'
+    else:
+        summary['bound'] = 'wait'
+    return summary
+
+
+def describe(sample):
+    # One line description of a sample or a summary.
+    return 'cpu %.0f%%, iowait %.0f%%, mem %sMB, disk r/w %.1f/%.1fMB/s, net rx/tx %.1f/%.1fMB/s' % (
+        sample['cpu'], sample['iowait'],
+        sample.get('memory_peak_mb', sample.get('memory_used_mb')),
+        sample['disk_read_mb_s'], sample['disk_write_mb_s'],
+        sample['net_rx_mb_s'], sample['net_tx_mb_s'],
+    )
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--interval', type='float', default=1)
+    parser.add_option('--max-seconds', type='float', default=6 * 3600)
+    parser.add_option('--output', default='/tmp/djangostack_telemetry.jsonl')
+    options, args = parser.parse_args()
+
+    deadline = time.time() + options.max_seconds
+    previous, previous_time = read_counters(), time.time()
+    while time.time() < deadline:
+        time.sleep(options.interval)
+        current, current_time = read_counters(), time.time()
+        record = sample(previous, current, current_time - previous_time)
+        record['time'] = round(current_time, 2)
+        with open(options.output, 'a') as output:
+            output.write(json.dumps(record, sort_keys=True) + '\n')
+        previous, previous_time = current, current_time
+
+
+if __name__ == '__main__':
+    main()
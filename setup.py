@@ -12,5 +12,8 @@ setup(
         'cuisine',
         'cuisine_postgresql',
         'fabric-taskset'
-    ]
+    ],
+    extras_require={
+        'asyncssh': ['asyncssh', 'Fabric3']
+    }
 )
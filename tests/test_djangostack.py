@@ -0,0 +1,151 @@
+import unittest
+
+from djangostack import DeployPlan, DjangoStack, nginx_worker_connections
+
+
+def django_stack(**kwargs):
+    options = {
+        'database_name': 'db',
+        'database_user': 'user',
+        'database_password': 'password',
+    }
+    options.update(kwargs)
+    return DjangoStack('project', **options)
+
+
+class RollingBatchesTest(unittest.TestCase):
+    hosts = ['web1', 'web2', 'web3', 'web4', 'web5']
+
+    def test_count(self):
+        stack = django_stack(rolling_batch_size=2)
+        self.assertEqual(
+            stack._rolling_batches(self.hosts), [['web1', 'web2'], ['web3', 'web4'], ['web5']]
+        )
+
+    def test_percentage_rounds_up(self):
+        stack = django_stack(rolling_batch_size='50%')
+        self.assertEqual(
+            stack._rolling_batches(self.hosts), [['web1', 'web2', 'web3'], ['web4', 'web5']]
+        )
+
+    def test_at_least_one_host_per_batch(self):
+        stack = django_stack(rolling_batch_size='1%')
+        self.assertEqual(len(stack._rolling_batches(self.hosts)), 5)
+        stack = django_stack(rolling_batch_size=0)
+        self.assertEqual(len(stack._rolling_batches(self.hosts)), 5)
+
+    def test_no_hosts(self):
+        self.assertEqual(django_stack()._rolling_batches([]), [])
+
+
+class PipRequirementInstalledTest(unittest.TestCase):
+    def setUp(self):
+        self.stack = django_stack()
+        self.stack.host_facts = {
+            'python_packages': ['Django==1.8.2', 'uWSGI==2.0.17', 'python_memcached==1.59']
+        }
+
+    def test_name(self):
+        self.assertTrue(self.stack._pip_requirement_installed('django'))
+        self.assertTrue(self.stack._pip_requirement_installed('UWSGI'))
+
+    def test_underscores_match_dashes(self):
+        self.assertTrue(self.stack._pip_requirement_installed('python-memcached'))
+
+    def test_pinned_version(self):
+        self.assertTrue(self.stack._pip_requirement_installed('django==1.8.2'))
+        self.assertFalse(self.stack._pip_requirement_installed('django==1.9'))
+
+    def test_not_installed(self):
+        self.assertFalse(self.stack._pip_requirement_installed('requests'))
+
+    def test_requirement_files_and_other_specifiers(self):
+        self.assertFalse(self.stack._pip_requirement_installed('-r requirements.txt'))
+        self.assertFalse(self.stack._pip_requirement_installed('django>=1.8'))
+
+    def test_no_facts(self):
+        self.stack.host_facts = {}
+        self.assertFalse(self.stack._pip_requirement_installed('django'))
+
+
+class DeployPlanTest(unittest.TestCase):
+    def plan(self):
+        return DeployPlan(
+            operation_timings={'package:gettext': 2.0, 'package:nginx': 30.0, 'command:a': 1.0},
+            stage_timings={'setup_python': 40.0, 'restart_services': 5.0},
+            stage_operations={
+                'setup_python': ['package:gettext', 'package:nginx'],
+                'restart_services': ['command:a'],
+            },
+        )
+
+    def test_sums_planned_operations(self):
+        # Only nginx is missing, so the first deployment's stage time does not apply.
+        plan = self.plan()
+        plan.add('setup_python', 'package', 'nginx')
+        self.assertEqual(plan.total_cost(), (30.0, 0))
+
+    def test_stage_time_when_operations_match(self):
+        plan = self.plan()
+        plan.add('restart_services', 'command', 'a')
+        self.assertEqual(plan.total_cost(), (5.0, 0))
+
+    def test_unknown_costs_are_counted(self):
+        plan = self.plan()
+        plan.add('setup_python', 'package', 'nginx')
+        plan.add('setup_python', 'package', 'vim')
+        plan.add('migrate', 'migration', 'app.0002_foo')
+        self.assertEqual(plan.stage_cost('setup_python', plan.stages()[0][1]), (30.0, 1))
+        self.assertEqual(plan.total_cost(), (30.0, 2))
+        self.assertEqual(
+            plan.render('web1')[0],
+            'Deployment plan for web1: 3 operations, estimated 30.0s + 2 operations of unknown cost'
+        )
+
+    def test_stages_keep_order(self):
+        plan = self.plan()
+        plan.add('setup_python', 'package', 'nginx')
+        plan.add('migrate', 'migration', 'app.0002_foo')
+        self.assertEqual([stage for stage, operations in plan.stages()], ['setup_python', 'migrate'])
+
+
+class NginxSiteConfigTest(unittest.TestCase):
+    def stack(self, **kwargs):
+        return django_stack(
+            web_server='nginx', uwsgi_ini_path='/etc/uwsgi/project.ini',
+            uwsgi_params_path='/etc/nginx/uwsgi_params', **kwargs
+        )
+
+    def test_minimal(self):
+        config = self.stack()._nginx_site_config()
+        self.assertIn('server unix:/tmp/project.sock;', config)
+        self.assertIn('uwsgi_pass project_uwsgi;', config)
+        self.assertIn('include /etc/nginx/uwsgi_params;', config)
+        self.assertNotIn('gzip_static', config)
+        self.assertNotIn('uwsgi_cache', config)
+
+    def test_static_and_micro_cache(self):
+        config = self.stack(
+            django_static_path='/srv/project/static/', nginx_micro_cache_seconds=2
+        )._nginx_site_config()
+        self.assertIn('alias /srv/project/static/;', config)
+        self.assertIn('gzip_static on;', config)
+        self.assertIn('map $uri $project_static_expires', config)
+        self.assertIn('keys_zone=project:10m', config)
+        self.assertIn('uwsgi_cache_valid 200 301 302 2s;', config)
+
+
+class NginxWorkerConnectionsTest(unittest.TestCase):
+    def test_sized_to_memory_per_cpu(self):
+        self.assertEqual(nginx_worker_connections(8000, 4), 16000)
+
+    def test_limited_by_open_files(self):
+        self.assertEqual(nginx_worker_connections(8000, 4, open_files=6000), 3000)
+
+    def test_bounds(self):
+        self.assertEqual(nginx_worker_connections(64, 8), 1024)
+        self.assertEqual(nginx_worker_connections(1024000, 2), 65535)
+
+
+if __name__ == '__main__':
+    unittest.main()
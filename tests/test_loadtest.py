@@ -0,0 +1,26 @@
+import unittest
+
+from djangostack.loadtest import percentile
+
+
+class PercentileTest(unittest.TestCase):
+    def test_nearest_rank(self):
+        values = list(range(1, 11))
+        self.assertEqual(percentile(values, 50), 5)
+        self.assertEqual(percentile(values, 90), 9)
+        self.assertEqual(percentile(values, 99), 10)
+        self.assertEqual(percentile(values, 100), 10)
+
+    def test_unsorted(self):
+        self.assertEqual(percentile([0.3, 0.1, 0.2], 50), 0.2)
+
+    def test_single_value(self):
+        self.assertEqual(percentile([0.5], 0), 0.5)
+        self.assertEqual(percentile([0.5], 99), 0.5)
+
+    def test_empty(self):
+        self.assertIsNone(percentile([], 50))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+from djangostack.telemetry import describe, summarise
+
+
+def sample(**values):
+    record = {
+        'cpu': 0.0, 'iowait': 0.0, 'memory_used_mb': 100, 'disk_read_mb_s': 0.0,
+        'disk_write_mb_s': 0.0, 'net_rx_mb_s': 0.0, 'net_tx_mb_s': 0.0,
+    }
+    record.update(values)
+    return record
+
+
+class SummariseTest(unittest.TestCase):
+    def test_no_samples(self):
+        self.assertIsNone(summarise([]))
+
+    def test_averages_and_peak_memory(self):
+        summary = summarise([sample(cpu=10, memory_used_mb=100), sample(cpu=30, memory_used_mb=300)])
+        self.assertEqual(summary['cpu'], 20)
+        self.assertEqual(summary['memory_peak_mb'], 300)
+        self.assertEqual(summary['samples'], 2)
+
+    def test_cpu_bound(self):
+        self.assertEqual(summarise([sample(cpu=90, iowait=30)])['bound'], 'cpu')
+
+    def test_disk_bound(self):
+        self.assertEqual(summarise([sample(cpu=20, iowait=40)])['bound'], 'disk')
+
+    def test_network_bound(self):
+        summary = summarise([sample(net_rx_mb_s=0.8, net_tx_mb_s=0.4)])
+        self.assertEqual(summary['bound'], 'network')
+
+    def test_wait_bound(self):
+        self.assertEqual(summarise([sample(cpu=5, iowait=1)])['bound'], 'wait')
+
+
+class DescribeTest(unittest.TestCase):
+    def test_sample(self):
+        self.assertEqual(
+            describe(sample(cpu=12.4, iowait=3, disk_read_mb_s=1.25)),
+            'cpu 12%, iowait 3%, mem 100MB, disk r/w 1.2/0.0MB/s, net rx/tx 0.0/0.0MB/s'
+        )
+
+    def test_summary_shows_peak_memory(self):
+        summary = summarise([sample(memory_used_mb=100), sample(memory_used_mb=250)])
+        self.assertIn('mem 250MB', describe(summary))
+
+
+if __name__ == '__main__':
+    unittest.main()